@@ -20,7 +20,8 @@
 
 # Import from itools
 from itools.core import merge_dicts, freeze
-from itools.datatypes import PathDataType, Unicode, String
+from itools.database import AndQuery, OrQuery, PhraseQuery
+from itools.datatypes import Integer, PathDataType, Unicode, String
 from itools.gettext import MSG
 from itools.uri import get_reference, Path
 from itools.web import get_context
@@ -35,7 +36,9 @@ from itws.tags import TagsAware
 
 # Import from crm
 from base_views import CRMFolder_AddImage
-from utils import get_path_and_view
+from cache import get_cache, invalidate_caches, lookup_size
+from comments import CommentsLog
+from utils import get_crm_path_query, get_path_and_view, get_sort_value
 
 
 class CRMFolder(TagsAware, RoleAware, Folder):
@@ -47,7 +50,13 @@ class CRMFolder(TagsAware, RoleAware, Folder):
         Folder.class_schema,
         RoleAware.class_schema,
         TagsAware.class_schema,
+        # Stored to count the documents by tag
+        tags=TagsAware.class_schema['tags'](stored=True),
         sprite16=String(stored=True),
+        crm_sort_title=Unicode(stored=True),
+        # The comments are indexed as documents of their own, by resource
+        crm_comments=Unicode(indexed=True),
+        crm_comment_of=String(indexed=True, stored=True),
         comment=Unicode(source='metadata', mandatory=True, multiple=True)))
     class_sprite16 = None
     class_views_shortcuts = ['goto_missions', 'goto_contacts',
@@ -82,20 +91,118 @@ class CRMFolder(TagsAware, RoleAware, Folder):
             adminbar_icon='crm16 crm16-company-add')
 
 
+    # Set while created, nothing links to the resource yet
+    is_new_resource = False
+
+
     def init_resource(self, **kw):
-        Folder.init_resource(self, **kw)
+        self.is_new_resource = True
+        try:
+            Folder.init_resource(self, **kw)
+
+            # Add current user as admin
+            username = get_context().user.name
+            admins = kw.get('admins', []) + [username]
+            self.set_property('admins', tuple(admins))
+        finally:
+            # Now other resources may link to it
+            self.is_new_resource = False
+
+
+    def get_property(self, name, language=None):
+        if name == 'comment':
+            return [comment.value for comment in self.get_comments()]
+        proxy = super(CRMFolder, self)
+        return proxy.get_property(name, language=language)
+
+
+    def set_property(self, name, value, language=None):
+        context = get_context()
+        invalidate_caches(context, self.class_id)
+        # Its brain is now out of date
+        get_cache(context, 'changed_resources')[str(self.get_abspath())] = True
+        if name == 'comment':
+            # Append the comment, or replace all of them given a list
+            log = self.get_comments_log(create=True)
+            n = log.get_n_comments()
+            if type(value) is list:
+                self.unindex_comments(n)
+                log.set_comments(value)
+                self.index_comments()
+            else:
+                log.add_comment(value)
+                # Only the new comment
+                self.index_comments(start=n)
+            self.metadata.database.change_resource(self)
+            return
+        proxy = super(CRMFolder, self)
+        return proxy.set_property(name, value, language=language)
+
+
+    def get_comments_log(self, create=False):
+        """ Return the handler of the comments, in the folder of the
+            resource. Without comments yet, the file is only added to the
+            database given "create", to write to.
+        """
+        key = '%s/.comments' % self.metadata.key[:-len('.metadata')]
+        database = self.metadata.database
+        log = database.get_handler(key, cls=CommentsLog, soft=True)
+        if log is None:
+            log = CommentsLog()
+            if create:
+                database.set_handler(key, log)
+        return log
+
+
+    def get_comments(self):
+        """ Return the comments as properties, from the oldest.
+        """
+        return self.get_comments_log().get_comments()
+
 
-        # Add current user as admin
-        username = get_context().user.name
-        admins = kw.get('admins', []) + [username]
-        self.set_property('admins', tuple(admins))
+    def get_comment_abspath(self, index):
+        return '%s/.comments/%d' % (self.get_abspath(), index)
+
+
+    def index_comments(self, start=0):
+        """ Index the comments from the given one, each as a catalog
+            document of its own, so indexing the resource again does not
+            go through its whole history.
+        """
+        catalog = self.metadata.database.catalog
+        log = self.get_comments_log()
+        abspath = str(self.get_abspath())
+        for i in range(start, log.get_n_comments()):
+            catalog.index_document({
+                'abspath': self.get_comment_abspath(i),
+                'format': 'crm-comment',
+                'crm_comment_of': abspath,
+                'crm_comments': log.get_comment(i).value})
+
+
+    def unindex_comments(self, n=None):
+        """ Remove the documents of the first n comments, or of all of
+            them.
+        """
+        if n is None:
+            n = self.get_comments_log().get_n_comments()
+        catalog = self.metadata.database.catalog
+        for i in range(n):
+            catalog.unindex_document(self.get_comment_abspath(i))
 
 
     def get_catalog_values(self):
         return merge_dicts(
             Folder.get_catalog_values(self),
             TagsAware.get_catalog_values(self),
-            sprite16=self.class_sprite16)
+            sprite16=self.class_sprite16,
+            crm_sort_title=get_sort_value(self.get_sort_title()))
+
+
+    def get_sort_title(self):
+        """Return the title to sort on.
+        """
+        return self.get_title()
 
 
     def get_edit_languages(self, context):
@@ -163,7 +270,7 @@ class CRMFolder(TagsAware, RoleAware, Folder):
             links.add(str(base.resolve2(path)))
 
         # comments
-        comments = self.metadata.get_property('comment') or []
+        comments = self.get_comments()
         for comment in comments:
             # XXX hardcoded, not typed
             for key in ('attachment',):
@@ -210,7 +317,7 @@ class CRMFolder(TagsAware, RoleAware, Folder):
                 self.set_property(key, Path(new_path))
 
         # comments
-        comments = self.metadata.get_property('comment') or []
+        comments = self.get_comments()
         for comment in comments:
             # XXX hardcoded, not typed
             for key in ('attachment',):
@@ -262,7 +369,7 @@ class CRMFolder(TagsAware, RoleAware, Folder):
             self.set_property(key, Path(new_path))
 
         # comments
-        comments = self.metadata.get_property('comment') or []
+        comments = self.get_comments()
         for comment in comments:
             # XXX hardcoded, not typed
             for key in ('attachment',):
@@ -285,3 +392,143 @@ class CRMFolder(TagsAware, RoleAware, Folder):
                 comment.set_parameter(key, new_path)
 
         self.set_property('comment', comments)
+
+
+
+class CRMContainer(Folder):
+    """ Base folder for Companies, Contacts and Missions, naming their
+        resources from a sequence.
+    """
+    class_schema = freeze(merge_dicts(
+        Folder.class_schema,
+        crm_sequence=Integer(source='metadata', default=0)))
+    class_code_format = None
+
+
+    def has_code(self, name):
+        """ Tell if a resource of this name exists, without loading it.
+        """
+        key = '%s/%s.metadata' % (self.metadata.key[:-len('.metadata')], name)
+        return self.metadata.database.has_handler(key)
+
+
+    def reserve_codes(self, n):
+        """ Return the next n unused names, allocated from the sequence at
+            once, e.g. to create resources in bulk.
+        """
+        index = self.get_property('crm_sequence')
+        if not index:
+            # Start after the existing names
+            index = len(self.get_names())
+        strformat = self.class_code_format
+        codes = []
+        while len(codes) < n:
+            name = strformat % index
+            index += 1
+            # Skip names created out of the sequence
+            if not self.has_code(name):
+                codes.append(name)
+        self.set_property('crm_sequence', index)
+        return codes
+
+
+    def generate_code(self):
+        """ Return the next unused name, allocated from the sequence.
+        """
+        return self.reserve_codes(1)[0]
+
+
+    def get_brains(self, names, context):
+        """ Return the brains of the given resources, by name.
+
+            The catalog is queried once for all the resources not already
+            looked up recently during this request.
+        """
+        cache = get_cache(context, 'brains:%s' % self.get_abspath(),
+                size=lookup_size)
+        brains = dict([(name, cache[name]) for name in names
+            if name in cache])
+        todo = set([name for name in names if name not in brains])
+        if todo:
+            for name in todo:
+                brains[name] = None
+            query = [PhraseQuery('name', name) for name in todo]
+            if len(query) == 1:
+                query = query[0]
+            else:
+                query = OrQuery(*query)
+            format = self.class_document_types[0].class_id
+            query = AndQuery(get_crm_path_query(self.parent),
+                    PhraseQuery('format', format), query)
+            for brain in context.root.search(query).get_documents():
+                brains[brain.name] = brain
+            for name in todo:
+                cache[name] = brains[name]
+        return dict([(name, brain) for name, brain in brains.iteritems()
+            if brain is not None])
+
+
+    def clear_brains(self, context):
+        """ Forget the brains looked up so far, e.g. between the chunks of a
+            long export.
+        """
+        get_cache(context, 'brains:%s' % self.get_abspath(),
+                size=lookup_size).clear()
+
+
+    def is_changed(self, name, context):
+        """ Tell if the given resource changed during the transaction, so
+            its brain is out of date.
+        """
+        changed = get_cache(context, 'changed_resources')
+        return '%s/%s' % (self.get_abspath(), name) in changed
+
+
+    def get_unchanged_brains(self, names, context):
+        """ Return the brains of the given resources that did not change
+            during the transaction, by name.
+        """
+        names = [name for name in names if not self.is_changed(name, context)]
+        return self.get_brains(names, context)
+
+
+    def del_resource(self, name, soft=False, **kw):
+        resource = self.get_resource(name, soft=soft)
+        if resource is not None:
+            invalidate_caches(get_context(), resource.class_id)
+            if isinstance(resource, CRMFolder):
+                resource.unindex_comments()
+        proxy = super(CRMContainer, self)
+        return proxy.del_resource(name, soft=soft, **kw)
+
+
+    def copy_resource(self, source_path, target_path, **kw):
+        proxy = super(CRMContainer, self)
+        result = proxy.copy_resource(source_path, target_path, **kw)
+        self.invalidate_caches_of(target_path)
+        # The comments were copied along
+        resource = self.get_resource(target_path, soft=True)
+        if isinstance(resource, CRMFolder):
+            resource.index_comments()
+        return result
+
+
+    def move_resource(self, source_path, target_path, **kw):
+        # Also clear the caches of where it comes from, e.g. another CRM
+        self.invalidate_caches_of(source_path)
+        # Index the comments again under the new path
+        resource = self.get_resource(source_path, soft=True)
+        if isinstance(resource, CRMFolder):
+            resource.unindex_comments()
+        proxy = super(CRMContainer, self)
+        result = proxy.move_resource(source_path, target_path, **kw)
+        resource = self.get_resource(target_path, soft=True)
+        if isinstance(resource, CRMFolder):
+            resource.index_comments()
+        return result
+
+
+    def invalidate_caches_of(self, path):
+        resource = self.get_resource(path, soft=True)
+        if resource is not None:
+            invalidate_caches(get_context(), resource.class_id)
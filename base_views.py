@@ -20,8 +20,9 @@ from decimal import Decimal as dec
 
 # Import from itools
 from itools.core import freeze
-from itools.datatypes import Decimal, Unicode
+from itools.datatypes import Decimal, Integer, Unicode
 from itools.gettext import MSG
+from itools.html import stream_to_str_as_html
 from itools.stl import STLTemplate
 from itools.web import STLView, get_context
 
@@ -34,6 +35,7 @@ from ikaaro.utils import make_stl_template
 
 # Import from crm
 from datatypes import MissionStatus, MissionStatusShortened
+from utils import get_user_title
 
 
 DUMMY_COMMENT = u"_"
@@ -159,17 +161,20 @@ class Comments_View(STLView):
     access = 'is_allowed_to_edit'
     title = MSG(u'Comments')
     template = '/ui/crm/comments/view.xml'
+    # Number of comments by page
+    batch_size = 20
 
     def get_namespace(self, resource, context):
+        start = context.get_query_value('comments_start', type=Integer,
+                default=0)
+        log = resource.get_comments_log()
+        n_comments = log.get_n_comments()
+        # From newer to older, only for the comments of the page
         ns_comments = []
-        comments = resource.metadata.get_property('comment') or []
-        for i, comment in enumerate(comments):
-            author = comment.get_parameter('author')
-            if author:
-                user = resource.get_resource('/users/' + author, soft=True)
-                if user:
-                    author = user.get_title()
-            comment_datetime = comment.get_parameter('date')
+        i = n_comments - 1 - start
+        while i >= 0 and len(ns_comments) < self.batch_size:
+            comment = log.get_comment(i)
+            i -= 1
             attachment = comment.get_parameter('attachment')
             value = comment.value
             if value == DUMMY_COMMENT:
@@ -178,25 +183,44 @@ class Comments_View(STLView):
                     continue
                 else:
                     value = u""
+            author = comment.get_parameter('author')
+            if author:
+                author = get_user_title(context, author)
+            comment_datetime = comment.get_parameter('date')
             # TODO Add diff (useful at creation without any comment)
             ns_comment = {
-                'id': i,
+                'id': i + 1,
                 'author': author,
                 'datetime': context.format_datetime(comment_datetime),
                 'attachment': attachment,
                 'comment': indent(value)}
             ns_comments.append(ns_comment)
-        # Sort comments from newer to older
-        ns_comments = list(reversed(ns_comments))
 
         path_to_resource = context.get_link(resource)
+        more = None
+        if i >= 0:
+            more = '%s/;more_comments?comments_start=%s' % (path_to_resource,
+                    n_comments - 1 - i)
         namespace = {
             'comments': ns_comments,
+            'more': more,
             'path_to_resource': path_to_resource}
         return namespace
 
 
 
+class Comments_More(Comments_View):
+    """ The next page of comments, as an HTML fragment to append to the
+        comments view.
+    """
+
+    def GET(self, resource, context):
+        events = super(Comments_More, self).GET(resource, context)
+        context.set_content_type('text/html; charset=UTF-8')
+        return stream_to_str_as_html(events)
+
+
+
 ############################################################################
 # CRMFolder
 ############################################################################
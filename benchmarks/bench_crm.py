@@ -0,0 +1,314 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark the CRM on synthetic data.
+
+Usage: python bench_crm.py [options]
+
+A new ikaaro instance is created in a temporary folder, filled with a CRM
+of the given size through the CRM API, then the hot paths are timed. The
+timings are written as JSON so runs can be compared.
+"""
+
+# Import from the Standard Library
+from datetime import date, datetime, time
+from decimal import Decimal as decimal
+from json import dumps
+from optparse import OptionParser
+from random import Random
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time as now
+
+# Import from itools
+from itools.csv import Property
+from itools.uri import get_reference
+from itools.web import set_context
+
+# Import from ikaaro
+from ikaaro.root import Root
+from ikaaro.server import Server, create_server, get_fake_context
+
+# Import from crm
+import crm
+from crm.crm import CRM
+from crm.csv_views import csv_writer_registry
+
+
+STATUS = ('opportunity', 'project', 'finished', 'nogo')
+WORDS = (u"alpha", u"bêta", u"gamma", u"delta", u"epsilon", u"zêta", u"eta",
+        u"thêta", u"iota", u"kappa", u"lambda", u"mu", u"nu", u"xi")
+
+
+class Benchmark(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.random = Random(options.seed)
+        self.timings = {}
+
+
+    def words(self, n):
+        choice = self.random.choice
+        return u" ".join([choice(WORDS) for i in range(n)]).capitalize()
+
+
+    #######################################################################
+    # Instance
+    def open(self):
+        options = self.options
+        self.target = '%s/instance' % mkdtemp()
+        create_server(self.target, options.email, options.password, Root,
+                modules=['crm'])
+        self.server = server = Server(self.target, read_only=False)
+        self.database = database = server.database
+        self.context = context = get_fake_context(database)
+        set_context(context)
+        self.root = root = database.get_resource('/')
+        context.root = root
+        context.site_root = root
+        context.user = root.get_user('0')
+        context.timestamp = datetime.now()
+
+
+    def close(self):
+        self.server.close()
+        if not self.options.keep:
+            rmtree(self.target.rsplit('/', 1)[0])
+
+
+    def commit(self):
+        self.database.save_changes()
+
+
+    #######################################################################
+    # Synthetic data
+    def generate(self):
+        options = self.options
+        random = self.random
+        context = self.context
+        language = self.root.get_default_language()
+
+        crm = self.root.make_resource('crm', CRM)
+        companies = crm.get_resource('companies')
+        contacts = crm.get_resource('contacts')
+        missions = crm.get_resource('missions')
+        for i in range(options.companies):
+            company = companies.add_company(
+                    title={language: self.words(2)},
+                    crm_c_town=self.words(1))
+            for j in range(options.contacts):
+                contact = contacts.add_contact(
+                        crm_p_company=company.name,
+                        crm_p_lastname=self.words(1),
+                        crm_p_firstname=self.words(1),
+                        crm_p_email='%s.%s@example.com' % (i, j),
+                        crm_p_status='lead')
+                for k in range(options.missions):
+                    mission = missions.add_mission(
+                        title={language: self.words(3)},
+                        crm_m_contact=[contact.name],
+                        crm_m_status=random.choice(STATUS),
+                        crm_m_amount=decimal(random.randint(1, 100) * 1000),
+                        crm_m_probability=random.randint(0, 100),
+                        crm_m_alert=datetime.combine(
+                            date.fromordinal(date.today().toordinal()
+                                + random.randint(-30, 30)),
+                            time(9, 0)),
+                        crm_m_nextaction=self.words(2),
+                        crm_m_assigned='0')
+                    for n in range(options.comments):
+                        comment = Property(self.words(20),
+                                date=context.timestamp, author='0')
+                        mission.set_property('comment', comment)
+            # Keep the transactions small
+            self.commit()
+        self.new_request()
+        self.crm = crm
+
+
+    #######################################################################
+    # Timings
+    def timeit(self, name, func, *args, **kw):
+        times = []
+        for i in range(self.options.repeat):
+            start = now()
+            func(*args, **kw)
+            times.append(now() - start)
+            # Do not keep the changes, nor the request caches
+            self.database.abort_changes()
+            self.new_request()
+        self.add_timing(name, times)
+
+
+    def new_request(self):
+        """ Forget the request caches and the classes changed, as a new
+            request would, so the process caches are used again.
+        """
+        self.context.crm_caches = {}
+        self.context.crm_changed = set()
+
+
+    def add_timing(self, name, times):
+        self.timings[name] = {
+            'runs': len(times),
+            'min': min(times),
+            'max': max(times),
+            'mean': sum(times) / len(times)}
+        print '%-45s %8.3f s' % (name, min(times))
+
+
+    def set_query(self, resource, view, **query):
+        context = self.context
+        query = '&'.join(['%s=%s' % item for item in query.iteritems()])
+        context.uri = get_reference('http://localhost%s/?%s' % (
+            resource.get_abspath(), query))
+        context.resource = resource
+        context.view = view
+        context.query = view.get_query(context)
+
+
+    def get_view(self, resource, view_name, **query):
+        view = resource.get_view(view_name)
+        self.set_query(resource, view, **query)
+        return view.GET(resource, self.context)
+
+
+    def csv_export(self, resource, view_name, csv_format):
+        view = resource.get_view(view_name)
+        self.set_query(resource, view)
+        return view.action_csv_export(resource, self.context,
+                {'csv_format': csv_format, 'ids': []})
+
+
+    def import_contacts(self, body):
+        view = self.crm.get_view('import_contacts')
+        self.set_query(self.crm, view)
+        return view.action(self.crm, self.context,
+                {'file': ('contacts.csv', 'text/csv', body)})
+
+
+    def reindex_contact(self, contact):
+        return contact.get_catalog_values()
+
+
+    def save_mission(self, mission):
+        view = mission.get_view('edit_form')
+        self.set_query(mission, view)
+        self.context.method = 'POST'
+        language = self.root.get_default_language()
+        form = {
+            'title': {language: mission.get_property('title')},
+            'description': {language: u""},
+            'comment': self.words(20),
+            'crm_m_nextaction': self.words(2),
+            'attachment': None,
+            'alert_date': date.today(),
+            'alert_time': time(9, 0),
+            'crm_m_status': 'project',
+            'crm_m_deadline': None,
+            'crm_m_amount': decimal('5000'),
+            'crm_m_probability': 50,
+            'crm_m_assigned': '0',
+            'crm_m_cc': [],
+            'tags': [],
+            'timestamp': None}
+        view.action(mission, self.context, form)
+        # What the commit would index, without committing
+        mission.get_catalog_values()
+
+
+    def run(self):
+        crm = self.crm
+        # Search tables with every sort column
+        for view_name in ('alerts', 'missions', 'contacts', 'companies'):
+            view = crm.get_view(view_name)
+            for name, title, sortable in view.get_table_columns(crm,
+                    self.context):
+                if not sortable:
+                    continue
+                self.timeit('%s sorted by %s' % (view_name, name),
+                        self.get_view, crm, view_name, sort_by=name)
+        # CSV export
+        for view_name in ('missions', 'contacts', 'companies'):
+            for csv_format in csv_writer_registry:
+                self.timeit('%s export to %s' % (view_name, csv_format),
+                        self.csv_export, crm, view_name, csv_format)
+        # Import the exported contacts back
+        body = self.csv_export(crm, 'contacts', 'ooo')
+        self.database.abort_changes()
+        self.new_request()
+        self.timeit('import contacts', self.import_contacts, body)
+        # Contact reindex
+        contact = crm.get_resource('contacts').get_resources().next()
+        self.timeit('contact reindex', self.reindex_contact, contact)
+        # Mission save
+        mission = crm.get_resource('missions').get_resources().next()
+        self.timeit('mission save', self.save_mission, mission)
+
+
+    def write(self):
+        options = self.options
+        results = {
+            'version': crm.__version__,
+            'date': datetime.now().isoformat(),
+            'size': {
+                'companies': options.companies,
+                'contacts': options.contacts,
+                'missions': options.missions,
+                'comments': options.comments},
+            'timings': self.timings}
+        output = open(options.output, 'w')
+        try:
+            output.write(dumps(results, indent=2, sort_keys=True))
+        finally:
+            output.close()
+
+
+
+if __name__ == '__main__':
+    usage = '%prog [options]'
+    parser = OptionParser(usage, description=__doc__.splitlines()[0])
+    parser.add_option('--companies', type='int', default=100,
+            help='number of companies')
+    parser.add_option('--contacts', type='int', default=5,
+            help='number of contacts per company')
+    parser.add_option('--missions', type='int', default=3,
+            help='number of missions per contact')
+    parser.add_option('--comments', type='int', default=5,
+            help='number of comments per mission')
+    parser.add_option('--repeat', type='int', default=3,
+            help='number of runs of each timing')
+    parser.add_option('--seed', type='int', default=0,
+            help='seed of the random data')
+    parser.add_option('-o', '--output', default='bench_crm.json',
+            help='file to write the results to (JSON)')
+    parser.add_option('--email', default='admin@example.com')
+    parser.add_option('--password', default='password')
+    parser.add_option('--keep', action='store_true', default=False,
+            help='do not remove the instance')
+    options, args = parser.parse_args()
+
+    benchmark = Benchmark(options)
+    benchmark.open()
+    try:
+        start = now()
+        benchmark.generate()
+        benchmark.add_timing('generate', [now() - start])
+        benchmark.run()
+    finally:
+        benchmark.close()
+    benchmark.write()
+    print 'Results written to', options.output
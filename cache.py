@@ -0,0 +1,84 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from itools
+from itools.core import LRUCache
+
+
+# The caches shared by all requests: {name: (generations, cache)}
+process_caches = {}
+
+# Incremented each time a resource of the given class is changed
+generations = {}
+
+# Number of values kept by the request caches of lookups, e.g. brains, so
+# a long request, such as an export, does not keep them all alive
+lookup_size = 2000
+
+
+def get_cache(context, name, scope='request', size=None, depends=()):
+    """ Return the cache of the given name, as a dictionary.
+
+        The "request" scope lives as long as the request, that is also the
+        transaction in ikaaro. The "process" scope is shared by all the
+        requests, and cleared when a resource of one of the "depends" class
+        ids changes.
+
+        Given a size, only the most recently used values are kept. Without
+        a context, an empty cache is returned each time.
+    """
+    if scope == 'request':
+        if context is None:
+            # Outside of a request, e.g. a script, compute again each time
+            return make_cache(size)
+        caches = getattr(context, 'crm_caches', None)
+        if caches is None:
+            caches = context.crm_caches = {}
+        cache = caches.get(name)
+        if cache is None:
+            cache = caches[name] = make_cache(size)
+        return cache
+    elif scope == 'process':
+        # Changed in this request, the catalog is not up to date before the
+        # commit, so do not share what would be computed from it
+        changed = getattr(context, 'crm_changed', None)
+        if changed and changed.intersection(depends):
+            return get_cache(context, name, size=size)
+        current = tuple([generations.get(x, 0) for x in depends])
+        cached = process_caches.get(name)
+        if cached is None or cached[0] != current:
+            cached = process_caches[name] = (current, make_cache(size))
+        return cached[1]
+    raise ValueError, 'unexpected cache scope "%s"' % scope
+
+
+
+def make_cache(size):
+    if size is None:
+        return {}
+    return LRUCache(size, size)
+
+
+
+def invalidate_caches(context, class_id):
+    """ Clear the process caches depending on resources of the given class.
+    """
+    generations[class_id] = generations.get(class_id, 0) + 1
+    if context is None:
+        return
+    changed = getattr(context, 'crm_changed', None)
+    if changed is None:
+        changed = context.crm_changed = set()
+    changed.add(class_id)
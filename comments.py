@@ -0,0 +1,135 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from json import dumps, loads
+
+# Import from itools
+from itools.core import freeze
+from itools.csv import Property
+from itools.datatypes import DateTime, String
+from itools.handlers import File
+
+
+comment_parameters = freeze({
+    'date': DateTime,
+    'author': String,
+    'attachment': String})
+
+
+def encode_comment(comment, parameters=comment_parameters):
+    """ Serialize a comment as a line of JSON.
+    """
+    if type(comment) is not Property:
+        comment = Property(comment)
+    record = {'value': comment.value}
+    for name, datatype in parameters.iteritems():
+        value = comment.get_parameter(name)
+        if value is not None:
+            record[name] = datatype.encode(value)
+    return dumps(record)
+
+
+
+def decode_comment(line, parameters=comment_parameters):
+    record = loads(line)
+    value = record.pop('value')
+    kw = {}
+    for name, value_str in record.iteritems():
+        datatype = parameters.get(str(name), String)
+        kw[str(name)] = datatype.decode(value_str.encode('utf_8'))
+    return Property(value, **kw)
+
+
+
+class CommentsLog(File):
+    """ The comments of a resource, a line each, from the oldest.
+
+        Adding a comment appends a line to the data already read, without
+        decoding the former comments. A comment is decoded only when read,
+        thanks to the index of the offsets of the lines.
+    """
+    class_mimetypes = ['text/x-crm-comments']
+    class_extension = 'comments'
+    # The datatypes of the parameters of the comments
+    parameters = comment_parameters
+
+
+    def reset(self):
+        self.offsets = None
+        self.added = []
+
+
+    def new(self, data=''):
+        File.new(self, data=data)
+        self.reset()
+
+
+    def _load_state_from_file(self, file):
+        File._load_state_from_file(self, file)
+        self.reset()
+
+
+    def to_str(self):
+        if self.added:
+            self.data = self.data + ''.join(self.added)
+            self.added = []
+        return self.data
+
+
+    def get_offsets(self):
+        if self.offsets is None:
+            data = self.to_str()
+            offsets = []
+            start = 0
+            end = data.find('\n')
+            while end != -1:
+                offsets.append((start, end))
+                start = end + 1
+                end = data.find('\n', start)
+            self.offsets = offsets
+        return self.offsets
+
+
+    #######################################################################
+    # API
+    #######################################################################
+    def get_n_comments(self):
+        return len(self.get_offsets())
+
+
+    def get_comment(self, index):
+        start, end = self.get_offsets()[index]
+        return decode_comment(self.to_str()[start:end], self.parameters)
+
+
+    def get_comments(self):
+        return [self.get_comment(i) for i in range(self.get_n_comments())]
+
+
+    def add_comment(self, comment):
+        self.set_changed()
+        line = '%s\n' % encode_comment(comment, self.parameters)
+        if self.offsets is not None:
+            start = len(self.data) + sum([len(x) for x in self.added])
+            self.offsets.append((start, start + len(line) - 1))
+        self.added.append(line)
+
+
+    def set_comments(self, comments):
+        self.set_changed()
+        self.data = ''.join(['%s\n' % encode_comment(comment, self.parameters)
+            for comment in comments])
+        self.reset()
@@ -16,22 +16,33 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
+from bisect import bisect_left
 
 # Import from itools
 from itools.core import merge_dicts, freeze
+from itools.database import AndQuery, PhraseQuery
 from itools.datatypes import PathDataType, String, Unicode
 from itools.gettext import MSG
+from itools.web import get_context
 
 # Import from ikaaro
-from ikaaro.folder import Folder
 from ikaaro.folder_views import Folder_BrowseContent
 
 # Import from crm
-from base import CRMFolder
+from base import CRMContainer, CRMFolder
 from base_views import CRMFolder_AddImage
+from cache import get_cache
 from company_views import Company_AddForm, Company_EditForm
-from company_views import Company_View
-from utils import generate_code
+from company_views import Company_View, Companies_SearchJSON
+from utils import get_crm_path_query, get_sort_value, reindex_brains
+
+
+def get_option_label(title):
+    # Reduce the length of the title
+    if len(title) > 63:
+        return u'%s...%s' % (title[:30], title[-30:])
+    return title
+
 
 
 class Company(CRMFolder):
@@ -39,7 +50,7 @@ class Company(CRMFolder):
         as logo, images, ...
     """
     class_id = 'company'
-    class_version = '20100916'
+    class_version = '20111020'
     class_icon16 = 'crm/icons/16x16/company.png'
     class_icon48 = 'crm/icons/48x48/company.png'
     class_schema = freeze(merge_dicts(
@@ -77,25 +88,114 @@ class Company(CRMFolder):
         return document
 
 
+    def set_property(self, name, value, language=None):
+        proxy = super(Company, self)
+        if name != 'title' or self.is_new_resource:
+            return proxy.set_property(name, value, language=language)
+
+        old_title = self.get_title()
+        result = proxy.set_property(name, value, language=language)
+        if self.get_title() != old_title:
+            # Update the contacts and missions showing the title
+            context = get_context()
+            crm = self.parent.parent
+            query = AndQuery(get_crm_path_query(crm),
+                    PhraseQuery('format', 'contact'),
+                    PhraseQuery('crm_p_company', self.name))
+            brains = context.root.search(query).get_documents()
+            reindex_brains(context, brains)
+            if brains:
+                contacts = crm.get_resource('contacts')
+                missions = contacts.get_missions(
+                        [brain.name for brain in brains], context)
+                # Their other contacts are read from the catalog, at once
+                contacts.prefetch_contacts([m_contact
+                    for m_brains in missions.itervalues()
+                    for m_brain in m_brains
+                    for m_contact in m_brain.crm_m_contact], context)
+                for m_brains in missions.itervalues():
+                    reindex_brains(context, m_brains)
+        return result
+
+
 
 ###################################
 # Container                       #
 ###################################
-class Companies(Folder):
+class Companies(CRMContainer):
     """ Container of "company" resources. """
     class_id = 'companies'
     class_title = MSG(u'Companies')
     class_version = '20100304'
     class_views = ['new_company', 'browse_content']
     class_document_types = [Company]
+    class_code_format = 'c%06d'
 
     # Views
     browse_content = Folder_BrowseContent(access='is_allowed_to_edit')
     new_company = Company_AddForm()
     add_logo = CRMFolder_AddImage()
+    search_json = Companies_SearchJSON()
 
 
-    def add_company(self, **values):
-        names = self.get_names()
-        name = generate_code(names, 'c%06d')
+    def add_company(self, name=None, **values):
+        if name is None:
+            name = self.generate_code()
         return self.make_resource(name, Company, **values)
+
+
+    def get_options_cache(self, context):
+        """ Return the companies sorted by title, computed once until a
+            company changes.
+        """
+        cache = get_cache(context, 'companies:%s' % self.get_abspath(),
+                scope='process', depends=('company',))
+        if 'options' in cache:
+            return cache
+        query = AndQuery(PhraseQuery('format', 'company'),
+                PhraseQuery('parent_path', str(self.get_abspath())))
+        results = context.root.search(query)
+        keys = []
+        options = []
+        titles = {}
+        for brain in results.get_documents(sort_by='crm_sort_title'):
+            keys.append(brain.crm_sort_title)
+            options.append({'name': brain.name, 'value': brain.title})
+            titles[brain.name] = brain.title
+        cache['keys'] = keys
+        cache['titles'] = titles
+        cache['options'] = options
+        return cache
+
+
+    def get_company_options(self, context):
+        """ Return the options of the companies, copied as the widgets set
+            them as selected.
+        """
+        return [{'name': option['name'],
+                 'value': get_option_label(option['value'])}
+                for option in self.get_options_cache(context)['options']]
+
+
+    def get_company_title(self, name, context):
+        """ Return the title of the given company, or None.
+        """
+        return self.get_options_cache(context)['titles'].get(name)
+
+
+    def search_company_options(self, prefix, context, size=20):
+        """ Return the options of the companies whose title starts with the
+            given prefix, case and accent independent.
+        """
+        cache = self.get_options_cache(context)
+        keys = cache['keys']
+        prefix = get_sort_value(prefix)
+        start = bisect_left(keys, prefix)
+        end = start
+        while end < len(keys) and keys[end].startswith(prefix):
+            end += 1
+            if size and end - start == size:
+                break
+        # The full title as the value of the input, shortened in the list
+        return [dict(option, label=get_option_label(option['value']))
+                for option in cache['options'][start:end]]
@@ -17,13 +17,14 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
+from json import dumps
 
 # Import from itools
 from itools.core import merge_dicts, freeze, is_thingy
 from itools.database import PhraseQuery
-from itools.datatypes import PathDataType, String, Unicode
+from itools.datatypes import Integer, PathDataType, String, Unicode
 from itools.gettext import MSG
-from itools.web import INFO, ERROR
+from itools.web import BaseView, INFO, ERROR
 
 # Import from ikaaro
 from ikaaro.autoform import ImageSelectorWidget, MultilineWidget
@@ -181,3 +182,22 @@ class Company_View(CompositeForm):
     subviews = [
             Company_EditForm(),
             Company_ViewContacts()]
+
+
+
+class Companies_SearchJSON(BaseView):
+    """ The companies whose title starts with the given prefix, for the
+        type-ahead of the contact forms.
+    """
+    access = 'is_allowed_to_edit'
+    query_schema = freeze({
+        'prefix': Unicode,
+        'size': Integer(default=20)})
+
+
+    def GET(self, resource, context):
+        prefix = context.query['prefix']
+        size = context.query['size']
+        options = resource.search_company_options(prefix, context, size)
+        context.set_content_type('application/json')
+        return dumps(options)
@@ -20,28 +20,39 @@ from decimal import Decimal as decimal
 
 # Import from itools
 from itools.core import merge_dicts, freeze
+from itools.database import AndQuery, OrQuery, PhraseQuery
 from itools.datatypes import Decimal, Email, Integer
 from itools.datatypes import String, Unicode
 from itools.gettext import MSG
+from itools.web import get_context
 
 # Import from ikaaro
 from ikaaro.comments import comment_datatype
-from ikaaro.folder import Folder
 from ikaaro.folder_views import Folder_BrowseContent
 
 # Import from crm
-from base import CRMFolder
-from base_views import Comments_View
+from base import CRMContainer, CRMFolder
+from base_views import Comments_More, Comments_View
+from cache import get_cache, lookup_size
 from contact_views import Contact_AddForm, Contact_EditForm, Contact_View
 from contact_views import Contact_SearchMissions, Contact_ViewMissions
+from contact_views import Contacts_SearchJSON
 from datatypes import ContactStatus
 from mission_views import Mission_EditForm
-from utils import generate_code
+from utils import get_crm_path_query, get_sort_value
+from utils import get_cached_resource, reindex_brains
+
+
+def format_contact_title(lastname, firstname, company_title):
+    if company_title:
+        return u'%s %s (%s)' % (lastname.upper(), firstname, company_title)
+    return u'%s %s' % (lastname.upper(), firstname)
+
 
 
 class Contact(CRMFolder):
     class_id = 'contact'
-    class_version = '20100924'
+    class_version = '20111020'
     class_icon16 = 'crm/icons/16x16/contact.png'
     class_icon48 = 'crm/icons/48x48/contact.png'
     # The class used to be named "Prospect" so the prefix is "p_"
@@ -53,21 +64,35 @@ class Contact(CRMFolder):
         crm_p_phone=Unicode(source='metadata', stored=True),
         crm_p_mobile=Unicode(source='metadata', stored=True),
         crm_p_email=Email(source='metadata', stored=True),
-        crm_p_position=Unicode(source='metadata'),
+        crm_p_position=Unicode(source='metadata', stored=True),
         crm_p_description=Unicode(source='metadata'),
         crm_p_status=ContactStatus(source='metadata', indexed=True,
             stored=True),
+        # The beginnings of the folded last name, first name and email, to
+        # search by prefix
+        crm_p_lookup=String(indexed=True, multiple=True),
         comment=comment_datatype,
-        # Store contact statistics
-        crm_p_assured=Decimal(stored=True),
-        crm_p_probable=Decimal(stored=True),
-        crm_p_opportunity=Integer(stored=True),
-        crm_p_project=Integer(stored=True),
-        crm_p_finished=Integer(stored=True),
-        crm_p_nogo=Integer(stored=True)))
+        # Store contact statistics (updated by the missions)
+        crm_p_assured=Decimal(source='metadata', default=decimal('0.0'),
+            stored=True),
+        crm_p_probable=Decimal(source='metadata', default=decimal('0.0'),
+            stored=True),
+        crm_p_opportunity=Integer(source='metadata', default=0, stored=True),
+        crm_p_project=Integer(source='metadata', default=0, stored=True),
+        crm_p_finished=Integer(source='metadata', default=0, stored=True),
+        crm_p_nogo=Integer(source='metadata', default=0, stored=True),
+        # The last modified mission (updated by the missions)
+        crm_p_last_mission=String(source='metadata', stored=True)))
     class_sprite16 = 'crm16-contact'
     class_title = MSG(u'Contact')
     class_views = ['view'] + CRMFolder.class_views_shortcuts
+    statistics_fields = ('crm_p_assured', 'crm_p_probable',
+            'crm_p_opportunity', 'crm_p_project', 'crm_p_finished',
+            'crm_p_nogo')
+    # The missions index these properties
+    missions_fields = ('crm_p_company', 'crm_p_lastname', 'crm_p_firstname')
+    # The longest beginning to look up
+    lookup_length = 20
 
     # Views
     browse_content = Folder_BrowseContent(access='is_allowed_to_edit')
@@ -75,6 +100,7 @@ class Contact(CRMFolder):
     edit_form = Contact_EditForm()
     view = Contact_View()
     view_comments = Comments_View()
+    more_comments = Comments_More()
     search_missions = Contact_SearchMissions()
     view_missions = Contact_ViewMissions()
 
@@ -98,98 +124,191 @@ class Contact(CRMFolder):
                 title = company.get_property('title')
             except AttributeError:
                 pass
-        # Index lastname, firstname, email and comment as text
+        # Index lastname, firstname, email and description as text
         values = [title or u'']
         values.append(get_property('crm_p_lastname') or u'')
         values.append(get_property('crm_p_firstname') or u'')
         values.append(get_property('crm_p_email') or u'')
         values.append(get_property('crm_p_description') or u'')
-        # Index all comments as 'text', and check any alert
-        values.extend(self.get_property('comment'))
         document['text'] = u' '.join(values)
         # Index status
         document['crm_p_status'] = get_property('crm_p_status')
+        # Index the beginnings to look up, as terms
+        lookup = set()
+        for name in ('crm_p_lastname', 'crm_p_firstname', 'crm_p_email'):
+            value = get_sort_value(get_property(name))
+            for i in range(1, min(len(value), self.lookup_length) + 1):
+                lookup.add(value[:i].encode('utf_8'))
+        document['crm_p_lookup'] = list(lookup)
 
-        # Index assured amount (sum projects amounts)
-        # Index probable amount (average missions amount by probability)
-        assured = probable = decimal('0.0')
-        cent = decimal('100.0')
-        document['crm_p_opportunity'] = 0
-        document['crm_p_project'] = 0
-        document['crm_p_finished'] = 0
-        document['crm_p_nogo'] = 0
-        missions = crm.get_resource('missions')
-        contact = self.name
-        for mission in missions.get_resources():
-            get_property = mission.get_property
-            if contact not in get_property('crm_m_contact'):
-                continue
-            status = get_property('crm_m_status')
-            if status:
-                document['crm_p_' + status] += 1
-            if status == 'nogo':
-                continue
-            # Get mission amount
-            amount = (get_property('crm_m_amount') or 0)
-            if status in ('project', 'finished'):
-                assured += amount
-            else:
-                # Get mission probability
-                if status == 'finished':
-                    value = amount
-                else:
-                    probability = (get_property('crm_m_probability') or 0)
-                    value = (probability * amount) / cent
-                probable += value
-        document['crm_p_assured'] = assured
-        document['crm_p_probable'] = probable
+        # Index statistics, maintained by the missions
+        for name in self.statistics_fields:
+            document[name] = get_property(name)
+        document['crm_p_last_mission'] = get_property('crm_p_last_mission')
 
         return document
 
 
+    def set_property(self, name, value, language=None):
+        proxy = super(Contact, self)
+        if name not in self.missions_fields or self.is_new_resource:
+            return proxy.set_property(name, value, language=language)
+
+        old_value = self.get_property(name)
+        result = proxy.set_property(name, value, language=language)
+        if self.get_property(name) != old_value:
+            # Update the missions of the contact, their other contacts are
+            # read from the catalog
+            context = get_context()
+            brains = self.get_missions(context)
+            self.parent.prefetch_contacts([m_contact for brain in brains
+                for m_contact in brain.crm_m_contact], context)
+            reindex_brains(context, brains)
+        return result
+
+
+    def get_sort_title(self):
+        # Tabulation sorts before any character, so by last name first
+        return u'%s\t%s' % (self.get_property('crm_p_lastname'),
+                self.get_property('crm_p_firstname'))
+
+
     def get_title(self, language=None):
-        p_lastname = self.get_property('crm_p_lastname').upper()
-        p_firstname = self.get_property('crm_p_firstname')
-        p_company = self.get_property('crm_p_company') or u''
+        p_company = self.get_property('crm_p_company')
+        company_title = None
         if p_company:
-            company = self.get_resource('../../companies/%s' % p_company,
-                    soft=True)
-            p_company =  u' (%s)' % company.get_title() if company else u''
-        return u'%s %s%s' % (p_lastname, p_firstname, p_company)
+            path = self.get_abspath().resolve2('../../companies/%s'
+                    % p_company)
+            context = get_context()
+            if context is None:
+                company = self.get_resource(path, soft=True)
+            else:
+                company = get_cached_resource(context, path)
+            if company is not None:
+                company_title = company.get_title()
+        return format_contact_title(self.get_property('crm_p_lastname'),
+                self.get_property('crm_p_firstname'), company_title)
 
 
     #############################################
     # CRM API
     #############################################
-    def get_first_mission(self, context):
-        root = context.root
-        crm = self.parent.parent
-        parent_path = str('%s/missions' % crm.get_abspath())
-        results = root.search(format='mission', parent_path=parent_path)
-        mission = results.get_documents(sort_by='mtime', reverse=True)
-        if not len(results):
-            return None
-        return mission[0].name
+    def update_statistics(self, delta):
+        """ Add the given differences to the statistics, instead of
+            computing them again from every mission.
+        """
+        for name, value in delta.iteritems():
+            value = self.get_property(name) + value
+            self.set_property(name, value)
+
+
+    def get_missions(self, context):
+        """ Return the brains of the missions of this contact, from the most
+            recently modified.
+        """
+        return self.parent.get_missions([self.name], context)[self.name]
+
+
+    def get_first_mission(self, context, exclude=None):
+        """ Return the name of the last modified mission of this contact,
+            but the excluded one, or None.
+        """
+        query = self.parent.get_missions_query([self.name])
+        results = context.root.search(query)
+        for brain in results.get_documents(sort_by='mtime', reverse=True,
+                size=2):
+            if brain.name != exclude:
+                return brain.name
+        return None
 
 
 
 ###################################
 # Container                       #
 ###################################
-class Contacts(Folder):
+class Contacts(CRMContainer):
     """ Container of "contact" resources. """
     class_id = 'contacts'
     class_version = '20100922'
     class_title = MSG(u'Contacts')
     class_views = ['new_contact', 'browse_content']
     class_document_types = [Contact]
+    class_code_format = 'c%06d'
 
     # Views
     browse_content = Folder_BrowseContent(access='is_allowed_to_edit')
     new_contact = Contact_AddForm()
+    search_json = Contacts_SearchJSON()
 
 
-    def add_contact(self, **values):
-        names = self.get_names()
-        name = generate_code(names, 'c%06d')
+    def add_contact(self, name=None, **values):
+        if name is None:
+            name = self.generate_code()
         return self.make_resource(name, Contact, **values)
+
+
+    def get_contacts(self, names, context):
+        """ Return the brains of the given contacts, by name.
+        """
+        return self.get_brains(names, context)
+
+
+    def prefetch_contacts(self, names, context):
+        """ Fetch the brains of the given contacts at once, e.g. of the
+            missions to index again, so they are not loaded one by one.
+        """
+        self.get_contacts(list(set(names)), context)
+
+
+    def search_contacts(self, prefix, context, size=20):
+        """ Return the brains of the contacts whose last name, first name
+            or email starts with the given prefix, case and accent
+            independent.
+        """
+        prefix = get_sort_value(prefix)[:Contact.lookup_length]
+        query = AndQuery(
+                PhraseQuery('parent_path', str(self.get_abspath())),
+                PhraseQuery('format', 'contact'),
+                PhraseQuery('crm_p_lookup', prefix.encode('utf_8')))
+        results = context.root.search(query)
+        return results.get_documents(sort_by='crm_sort_title', size=size)
+
+
+    def get_missions_query(self, names):
+        """ Query the missions of the given contacts, using the
+            "crm_m_contact" index.
+        """
+        query = [PhraseQuery('crm_m_contact', name) for name in names]
+        if len(query) == 1:
+            query = query[0]
+        else:
+            query = OrQuery(*query)
+        return AndQuery(get_crm_path_query(self.parent),
+                PhraseQuery('format', 'mission'), query)
+
+
+    def get_missions(self, names, context):
+        """ Return the brains of the missions of the given contacts, from
+            the most recently modified, by contact name.
+
+            The catalog is queried once for all the contacts not already
+            looked up recently during this request.
+        """
+        cache = get_cache(context,
+                'missions_by_contact:%s' % self.get_abspath(),
+                size=lookup_size)
+        missions = dict([(name, cache[name]) for name in names
+            if name in cache])
+        todo = set([name for name in names if name not in missions])
+        if todo:
+            for name in todo:
+                missions[name] = []
+            results = context.root.search(self.get_missions_query(todo))
+            for brain in results.get_documents(sort_by='mtime',
+                    reverse=True):
+                for m_contact in brain.crm_m_contact:
+                    if m_contact in todo:
+                        missions[m_contact].append(brain)
+            for name in todo:
+                cache[name] = missions[name]
+        return missions
@@ -18,6 +18,7 @@
 
 # Import from the Standard Library
 from datetime import date
+from json import dumps
 
 # Import from itools
 from itools.core import merge_dicts, freeze
@@ -25,7 +26,7 @@ from itools.csv import Property
 from itools.database import AndQuery, OrQuery, PhraseQuery
 from itools.datatypes import Email, Integer, Unicode, DateTime, String
 from itools.gettext import MSG
-from itools.web import FormError
+from itools.web import BaseView, FormError
 
 # Import from ikaaro
 from ikaaro.autoform import MultilineWidget, RadioWidget, TextWidget
@@ -42,7 +43,8 @@ from datatypes import CompanyName, MissionStatus, ContactStatus
 from menus import MissionsMenu, ContactsByContactMenu, CompaniesMenu
 from mission_views import mission_schema, mission_widgets
 from mission_views import get_changes, send_notification, MSG_CONTACT_ADDED
-from utils import get_crm, get_crm_path_query
+from notifications import send_notifications
+from utils import get_crm, get_text_query, LazyResource
 from views import TagsAware_Edit
 from widgets import EmailWidget, MultipleCheckboxWidget
 from widgets import SelectCompanyWidget
@@ -87,6 +89,7 @@ class Contact_EditForm(TagsAware_Edit, DBResource_Edit):
     access = 'is_allowed_to_edit'
     title = MSG(u'Edit Contact')
     styles = ['/ui/crm/style.css']
+    scripts = ['/ui/crm/javascript.js']
     query_schema = contact_schema
     submit_value = MSG(u'Update Contact')
 
@@ -159,6 +162,7 @@ class Contact_AddForm(CRMFolder_AddForm, Contact_EditForm):
     title = MSG(u'New Contact')
     template = '/ui/crm/contact/new.xml'
     styles = ['/ui/crm/style.css']
+    scripts = ['/ui/crm/javascript.js']
     query_schema = freeze(merge_dicts(
         contact_schema,
         mission_schema,
@@ -280,6 +284,7 @@ class Contact_AddForm(CRMFolder_AddForm, Contact_EditForm):
                 changes = get_changes(mission, context, m_values, new=True)
                 send_notification(mission, context, m_values, changes,
                         new=True)
+                send_notifications(context, get_crm(resource))
             goto = context.get_link(mission)
             return context.come_back(MSG_CONTACT_ADDED, goto=goto)
         else:
@@ -330,13 +335,12 @@ class Contact_SearchMissions(SearchForm):
 
         # Build the query
         args = list(args)
-        args.append(PhraseQuery('format', 'mission'))
-        args.append(PhraseQuery('crm_m_contact', resource.name))
-        missions = resource.parent.parent.get_resource('missions')
-        abspath = str(missions.get_canonical_path())
-        args.append(PhraseQuery('parent_path', abspath))
+        args.append(resource.parent.get_missions_query([resource.name]))
         if search_text:
-            args.append(PhraseQuery(field, search_text))
+            if field == 'text':
+                args.append(get_text_query(context, search_text))
+            else:
+                args.append(PhraseQuery(field, search_text))
         # Insert status filter
         if m_status:
             status_query = []
@@ -349,9 +353,7 @@ class Contact_SearchMissions(SearchForm):
             query = AndQuery(*args)
 
         # Ok
-        crm = get_crm(resource)
-        base_path_query = get_crm_path_query(crm)
-        return context.root.search(AndQuery(query, base_path_query))
+        return context.root.search(query)
 
 
     def get_item_value(self, resource, context, item, column):
@@ -359,29 +361,28 @@ class Contact_SearchMissions(SearchForm):
         if column == 'checkbox':
             # checkbox
             return item_brain.name, False
-        get_property = item_resource.get_property
         if column == 'sprite':
             # Status
-            return StatusIcon(get_property('crm_m_status'))
-        # FIXME
+            return StatusIcon(item_brain.crm_m_status)
         elif column == 'title':
             # Title
-            return get_property(column), context.get_link(item_resource)
+            return item_brain.title, context.get_link(item_brain)
         elif column == 'status':
             # Status
-            return MissionStatus.get_value(get_property('crm_m_status'))
+            return MissionStatus.get_value(item_brain.crm_m_status)
         elif column == 'mtime':
             # Last Modified
             return context.format_datetime(item_brain.mtime)
         elif column == 'crm_m_amount':
-            value = get_property(column)
+            value = item_brain.crm_m_amount
             if value:
                 value = context.format_number(value, curr=u' €')
             return value
         try:
             return getattr(item_brain, column)
         except AttributeError:
-            return get_property(column)
+            # Loads the resource
+            return item_resource.get_property(column)
 
 
     def sort_and_batch(self, resource, context, results):
@@ -391,7 +392,8 @@ class Contact_SearchMissions(SearchForm):
         reverse = context.query['reverse']
         items = results.get_documents(sort_by=sort_by, reverse=reverse,
                                       start=start, size=size)
-        return [(x, resource.get_resource(x.abspath)) for x in items]
+        # Render from the brains, the resources are loaded only if needed
+        return [(x, LazyResource(context, x)) for x in items]
 
 
     #######################################################################
@@ -431,15 +433,13 @@ class Contact_ViewMissions(Contact_SearchMissions):
     def get_items(self, resource, context, *args):
         # Build the query
         args = list(args)
-        args.append(PhraseQuery('crm_m_contact', resource.name))
+        args.append(resource.parent.get_missions_query([resource.name]))
         if len(args) == 1:
             query = args[0]
         else:
             query = AndQuery(*args)
         # Ok
-        crm = get_crm(resource)
-        base_path_query = get_crm_path_query(crm)
-        return context.root.search(AndQuery(query, base_path_query))
+        return context.root.search(query)
 
 
 
@@ -448,6 +448,7 @@ class Contact_View(CompositeForm):
     title = MSG(u'View Contact')
     template = '/ui/crm/contact/view.xml'
     styles = ['/ui/crm/style.css']
+    scripts = ['/ui/crm/javascript.js']
     context_menus = [
             MissionsMenu(contact_menu=ContactsByContactMenu()),
             ContactsByContactMenu(),
@@ -471,3 +472,32 @@ class Contact_View(CompositeForm):
             'view_comments': view_comments,
             'view_missions': view_missions }
         return namespace
+
+
+
+class Contacts_SearchJSON(BaseView):
+    """ The contacts whose last name, first name or email starts with the
+        given prefix, to pick them without listing them all.
+    """
+    access = 'is_allowed_to_edit'
+    query_schema = freeze({
+        'prefix': Unicode,
+        'size': Integer(default=20)})
+
+
+    def GET(self, resource, context):
+        prefix = context.query['prefix']
+        size = context.query['size']
+        contacts = []
+        if prefix:
+            for brain in resource.search_contacts(prefix, context, size):
+                label = brain.title
+                if brain.crm_p_email:
+                    label = u'%s <%s>' % (label, brain.crm_p_email)
+                contacts.append({
+                    'name': brain.name,
+                    'value': brain.title,
+                    'label': label,
+                    'email': brain.crm_p_email})
+        context.set_content_type('application/json')
+        return dumps(contacts)
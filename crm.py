@@ -18,21 +18,26 @@
 # Import from the Standard Library
 
 # Import from itools
-from itools.core import get_abspath
+from itools.core import freeze, get_abspath, merge_dicts
+from itools.datatypes import Integer, String
 from itools.gettext import MSG
 
 # Import from ikaaro
 from ikaaro.folder import Folder
 from ikaaro.folder_views import Folder_BrowseContent, GoToSpecificDocument
-from ikaaro.resource_views import DBResource_Backlinks, DBResource_Edit
+from ikaaro.resource_views import DBResource_Backlinks
 from ikaaro.skins import register_skin
 
 # Import from crm
 from company import Companies
-from contact import Contacts
-from crm_views import CRM_SearchMissions, CRM_SearchContacts
+from contact import Contact, Contacts
+from crm_views import CRM_Alerts, CRM_SearchMissions, CRM_SearchContacts
 from crm_views import CRM_SearchCompanies, CRM_Test, CRM_ImportContacts
+from crm_views import CRM_Edit, CRM_RepairStatistics, CRM_SendDigests
+from crm_views import CRM_IndexComments
+from crm_views import CRM_SendDueDigests
 from mission import Missions
+from notifications import DigestQueue
 
 
 class CRM(Folder):
@@ -42,7 +47,7 @@ class CRM(Folder):
         - addresses (companies and contacts)
     """
     class_id = 'crm'
-    class_version = '20100920'
+    class_version = '20111019'
     class_title = MSG(u'CRM')
     class_icon16 = 'crm/icons/16x16/crm.png'
     class_icon48 = 'crm/icons/48x48/crm.png'
@@ -52,16 +57,24 @@ class CRM(Folder):
     __fixed_handlers__ = Folder.__fixed_handlers__ + ['companies',
             'contacts', 'missions']
 
+    class_schema = freeze(merge_dicts(
+        Folder.class_schema,
+        # Send the notifications together over this number of minutes
+        crm_digest_window=Integer(source='metadata', default=0),
+        # The secret to give to send the due digests, e.g. from cron
+        crm_digest_token=String(source='metadata')))
+
     # Hide itws sidebar
     display_sidebar = False
 
     # Views
+    alerts = CRM_Alerts()
     missions = CRM_SearchMissions()
     contacts = CRM_SearchContacts()
     companies = CRM_SearchCompanies()
     browse_content = Folder_BrowseContent(access='is_allowed_to_edit')
     preview_content = Folder_BrowseContent(access='is_allowed_to_edit')
-    edit = DBResource_Edit(styles=['/ui/crm/style.css'])
+    edit = CRM_Edit()
     backlinks = DBResource_Backlinks(access='is_allowed_to_edit')
     goto_contacts = GoToSpecificDocument(specific_document='contacts',
         adminbar_icon='crm16 crm16-contact-add',
@@ -70,6 +83,10 @@ class CRM(Folder):
         adminbar_icon='crm16 crm16-company-add',
         title=MSG(u'New company'), access='is_allowed_to_edit')
     import_contacts = CRM_ImportContacts()
+    repair_statistics = CRM_RepairStatistics()
+    index_comments = CRM_IndexComments()
+    send_digests = CRM_SendDigests()
+    send_due_digests = CRM_SendDueDigests()
     test = CRM_Test()
 
 
@@ -86,6 +103,85 @@ class CRM(Folder):
             title={'en': u'Missions', 'fr': u'Missions'})
 
 
+    #############################################
+    # CRM API
+    #############################################
+    def get_digest_queue(self, create=False):
+        """ Return the handler of the notifications waiting for the
+            digest. Without any yet, the file is only added to the database
+            given "create", to write to.
+        """
+        key = '%s/.digest' % self.metadata.key[:-len('.metadata')]
+        database = self.metadata.database
+        queue = database.get_handler(key, cls=DigestQueue, soft=True)
+        if queue is None:
+            queue = DigestQueue()
+            if create:
+                database.set_handler(key, queue)
+        return queue
+
+
+    def index_comments(self):
+        """ Index again the comments of every company, contact and
+            mission, e.g. once the catalog is rebuilt from the resources.
+            Return the number of resources.
+        """
+        n = 0
+        for name in ('companies', 'contacts', 'missions'):
+            for resource in self.get_resource(name).get_resources():
+                resource.unindex_comments()
+                resource.index_comments()
+                n += 1
+        return n
+
+
+    def rebuild_statistics(self, force=False):
+        """ Compute again the statistics and the last mission of every
+            contact in a single pass over the missions. Return the number of
+            contacts fixed.
+
+            The values are computed from and compared with the metadata, as
+            the catalog may be out of date, e.g. during an update. Given
+            "force", they are written even when equal.
+        """
+        # Sum the statistics of the missions
+        statistics = {}
+        last_missions = {}
+        for mission in self.get_resource('missions').get_resources():
+            m_statistics = mission.get_statistics()
+            mtime = mission.get_property('mtime')
+            for m_contact in mission.get_property('crm_m_contact'):
+                p_statistics = statistics.setdefault(m_contact, {})
+                for key, value in m_statistics.iteritems():
+                    p_statistics[key] = p_statistics.get(key, 0) + value
+                # The latest modified, as kept by Mission.set_property
+                last_mission = last_missions.get(m_contact)
+                if last_mission is None or last_mission[0] < mtime:
+                    last_missions[m_contact] = (mtime, mission.name)
+
+        # Only write the contacts to fix
+        fields = Contact.statistics_fields
+        n = 0
+        for contact in self.get_resource('contacts').get_resources():
+            p_statistics = statistics.get(contact.name, {})
+            changes = {}
+            for key in fields:
+                value = p_statistics.get(key, 0)
+                if force or (contact.get_property(key) or 0) != value:
+                    changes[key] = value
+            last_mission = last_missions.get(contact.name, (None, None))[1]
+            if (force
+                    or contact.get_property('crm_p_last_mission')
+                    != last_mission):
+                changes['crm_p_last_mission'] = last_mission
+            if not changes:
+                continue
+            for key, value in changes.iteritems():
+                contact.set_property(key, value)
+            n += 1
+        return n
+
+
 
 # Register crm skin
 path = get_abspath('ui')
@@ -17,24 +17,27 @@
 
 # Import from the Standard Library
 from datetime import date, time, datetime, timedelta
-from decimal import Decimal as dec
+from operator import attrgetter
 
 # Import from itools
-from itools.core import merge_dicts, freeze, thingy_property, thingy
+from itools.core import merge_dicts, freeze, thingy_property
 from itools.csv import CSVFile
-from itools.database import AndQuery, OrQuery, PhraseQuery, TextQuery
+from itools.database import AndQuery, OrQuery, PhraseQuery
+from itools.database import NotQuery, RangeQuery
 from itools.datatypes import Boolean, String, Integer, Date, XMLContent
 from itools.gettext import MSG
-from itools.handlers.utils import transmap
 from itools.stl import STLTemplate
-from itools.web import STLView, get_context, INFO, ERROR
+from itools.web import BaseView, STLView, get_context, INFO, ERROR
+from itools.web import Forbidden
 
 # Import from ikaaro
 from ikaaro.autoform import TextWidget, SelectWidget, DateWidget, FileWidget
 from ikaaro.autoform import AutoForm, Widget
 from ikaaro.buttons import Button, BrowseButton
 from ikaaro.datatypes import FileDataType
-from ikaaro.utils import make_stl_template, get_base_path_query
+from ikaaro.registry import get_resource_class
+from ikaaro.resource_views import DBResource_Edit
+from ikaaro.utils import make_stl_template
 from ikaaro.views import SearchForm
 
 # Import from itws
@@ -43,21 +46,39 @@ from itws.tags import TagsList
 # Import from crm
 from base_views import Icon, ShortStatusIcon, PhoneIcon, get_alert_icon
 from base_views import format_amount
-from csv_views import cleanup_gmail_csv, find_value_by_column
+from cache import get_cache
+from csv_views import cleanup_gmail_csv
 from csv_views import Folder_CSV_Export, CSVColumn
 from datatypes import MissionStatus, MissionStatusShortened, ContactStatus
-from datatypes import AssignedList
+from datatypes import AssignedList, AlertPeriod
+from notifications import queue_notification, send_digests
+from notifications import send_notifications
 from utils import get_crm, get_crm_path_query
+from utils import get_aggregates, get_sort_value, LazyResource
+from utils import get_text_query, get_user_title
 from widgets import MultipleCheckboxWidget
 
 
-MSG_MISSIONS_POSTPONED = INFO(u"Missions postponed to {postpone}: "
-        u"{missions}.", format='replace_html')
+MSG_MISSIONS_POSTPONED = INFO(u"{n} missions postponed to {postpone}.")
+MSG_MISSIONS_UPDATED = INFO(u"{n} missions updated.")
+ERR_NO_MISSION_SELECTED = ERROR(u"No mission selected.")
+ERR_NO_POSTPONE_DATE = ERROR(u"Choose the date to postpone the alerts to.")
 MSG_CONTACTS_ADDED = INFO(u"The following {n} contacts were added: "
         u"{added}", format='replace_html')
 MSG_CONTACTS_UPDATED = INFO(u"The following {n} contacts were updated: "
         u"{updated}", format='replace_html')
 ERR_NO_CONTACT_FOUND = ERROR(u"No contact found.")
+MSG_STATISTICS_REBUILT = INFO(u"The statistics of {n} contacts were fixed.")
+MSG_DIGESTS_SENT = INFO(u"{n} digests sent.")
+MSG_COMMENTS_INDEXED = INFO(u"The comments of {n} resources were indexed.")
+
+
+BULK_SUBJECT = MSG(u"[{crm_title}] {n} missions changed by {user_title}")
+BULK_LINE = MSG(u"#{name} {title}: {change}\n{uri}")
+BULK_ALERT = MSG(u"alert on {date}")
+BULK_ASSIGNED = MSG(u"assigned to {user_title}")
+BULK_STATUS = MSG(u"status set to {status}")
+BULK_TAG = MSG(u"tagged {tag}")
 
 
 GMAIL_LAST_NAME = u"Last Name"
@@ -148,6 +169,10 @@ class CRM_Search(Folder_CSV_Export, SearchForm):
         SelectWidget('tags', title=MSG(u"Tag"))])
     search_action = SearchButton
 
+    # Columns sorted by the catalog on another field
+    sort_fields = freeze({
+        'title': 'crm_sort_title'})
+
 
     def _get_query(self, resource, context, *args):
         crm = get_crm(resource)
@@ -159,7 +184,7 @@ class CRM_Search(Folder_CSV_Export, SearchForm):
         args.append(PhraseQuery('format', self.search_format))
         args.append(get_crm_path_query(crm))
         if search_term:
-            args.append(PhraseQuery('text', search_term))
+            args.append(get_text_query(context, search_term))
         if tags:
             args.append(PhraseQuery('tags', tags))
 
@@ -184,6 +209,8 @@ class CRM_Search(Folder_CSV_Export, SearchForm):
         namespace = SearchForm.get_namespace(self, resource, context)
         namespace['csv'] = Folder_CSV_Export.get_csv_namespace(self,
                 resource, context)
+        # Offer to apply the table actions to all the results
+        namespace['all_results'] = False
         return namespace
 
 
@@ -192,29 +219,24 @@ class CRM_Search(Folder_CSV_Export, SearchForm):
         return context.root.search(query)
 
 
-    def get_item_value(self, resource, context, item, column, cache={}):
+    def get_item_value(self, resource, context, item, column):
         item_brain, item_resource = item
         if column == 'checkbox':
             return item_brain.name, False
         elif column == 'sprite':
             return Icon(item_brain.sprite16)
         elif column == 'title':
-            href = context.get_link(item_resource)
+            href = context.get_link(item_brain)
             return item_brain.title, href
         elif column == 'mtime':
             return context.format_datetime(item_brain.mtime)
         try:
             return getattr(item_brain, column)
         except AttributeError:
+            # Loads the resource
             return item_resource.get_property(column)
 
 
-    def get_key_sorted_by_title(self):
-        def key(item):
-            return item.title.lower().translate(transmap)
-        return key
-
-
     def sort_and_batch(self, resource, context, results):
         start = context.query['batch_start']
         size = context.query['batch_size']
@@ -222,10 +244,16 @@ class CRM_Search(Folder_CSV_Export, SearchForm):
         reverse = context.query['reverse']
 
         if sort_by is None:
-            get_key = None
+            get_documents = get_key = None
         else:
+            # Sort keys computed at indexing time
+            sort_by = self.sort_fields.get(sort_by, sort_by)
+            get_documents = getattr(self,
+                    'get_documents_sorted_by_' + sort_by, None)
             get_key = getattr(self, 'get_key_sorted_by_' + sort_by, None)
-        if get_key is not None:
+        if get_documents is not None:
+            items = get_documents(results, start, size, reverse)
+        elif get_key is not None:
             items = results.get_documents()
             items.sort(key=get_key(), reverse=reverse)
             if size:
@@ -236,7 +264,8 @@ class CRM_Search(Folder_CSV_Export, SearchForm):
             items = results.get_documents(sort_by=sort_by, reverse=reverse,
                     start=start, size=size)
 
-        return [(x, resource.get_resource(x.abspath)) for x in items]
+        # Render from the brains, the resources are loaded only if needed
+        return [(x, LazyResource(context, x)) for x in items]
 
 
     def get_table_titles(self, resource, context):
@@ -270,6 +299,91 @@ class PostponeAlerts(DateWidget, BrowseButton):
 
 
 
+class ReassignMissions(BrowseButton):
+    access = 'is_allowed_to_edit'
+    template = (make_stl_template('''
+        Assign selected missions to
+        <select name="bulk_assigned">
+          <option stl:repeat="option options" value="${option/name}"
+            >${option/value}</option>
+        </select>''')
+        + BrowseButton.template)
+    name = 'bulk_assigned'
+    title = MSG(u"Reassign")
+    confirm = MSG(u"Are you sure you want to reassign the selected "
+            u"missions?")
+
+
+    @thingy_property
+    def options(cls):
+        return AssignedList().get_options()
+
+
+
+class ChangeMissionsStatus(BrowseButton):
+    access = 'is_allowed_to_edit'
+    template = (make_stl_template('''
+        Set status of selected missions to
+        <select name="bulk_status">
+          <option stl:repeat="option options" value="${option/name}"
+            >${option/value}</option>
+        </select>''')
+        + BrowseButton.template)
+    name = 'bulk_status'
+    title = MSG(u"Change Status")
+    confirm = MSG(u"Are you sure you want to change the status of the "
+            u"selected missions?")
+
+
+    @thingy_property
+    def options(cls):
+        return MissionStatus.get_options()
+
+
+
+class TagMissions(BrowseButton):
+    access = 'is_allowed_to_edit'
+    template = (make_stl_template('''
+        Tag selected missions with
+        <select name="bulk_tag">
+          <option stl:repeat="option options" value="${option/name}"
+            >${option/value}</option>
+        </select>''')
+        + BrowseButton.template)
+    name = 'bulk_tag'
+    title = MSG(u"Add Tag")
+
+
+    @thingy_property
+    def options(cls):
+        return TagsList().get_options()
+
+
+
+def get_alert_query(period):
+    """ Query the missions by alert date:
+        - "past": before today
+        - "today"
+        - "future": after today
+        - "due": until the end of today
+    """
+    today = date.today()
+    start_of_day = datetime.combine(today, time(0, 0))
+    end_of_day = datetime.combine(today, time(23, 59, 59))
+    if period == 'past':
+        return RangeQuery('crm_m_alert', None,
+                start_of_day - timedelta(seconds=1))
+    elif period == 'today':
+        return RangeQuery('crm_m_alert', start_of_day, end_of_day)
+    elif period == 'future':
+        return RangeQuery('crm_m_alert', end_of_day + timedelta(seconds=1),
+                None)
+    elif period == 'due':
+        return RangeQuery('crm_m_alert', None, end_of_day)
+    raise ValueError, period
+
+
+
 class CRM_SearchMissions(CRM_Search):
     title = MSG(u'Missions')
     query_schema = freeze(merge_dicts(
@@ -290,6 +404,13 @@ class CRM_SearchMissions(CRM_Search):
             + CRM_Search.search_widgets[1:])
     search_format = 'mission'
 
+    sort_fields = freeze(merge_dicts(
+        CRM_Search.sort_fields,
+        status='crm_m_status',
+        crm_m_nextaction='crm_m_sort_nextaction',
+        contacts='crm_m_sort_contact',
+        company='crm_m_sort_company'))
+
     table_columns = freeze([
         ('checkbox', None, False),
         ('alert', MSG(u" "), True),
@@ -301,11 +422,27 @@ class CRM_SearchMissions(CRM_Search):
         ('company', MSG(u'Company'), True),
         ('assigned', MSG(u'Assigned To'), True),
         ('mtime', MSG(u'Last Modified'), True)])
-    table_actions = freeze([PostponeAlerts])
+    table_actions = freeze([PostponeAlerts, ReassignMissions,
+        ChangeMissionsStatus, TagMissions])
+    scripts = ['/ui/crm/javascript.js']
 
-    action_postpone_schema = freeze({
+    # The selected missions, or all the missions found, given the hidden
+    # field set by the "all-results" checkbox
+    bulk_schema = freeze({
         'ids': String(multiple=True, mandatory=False),
-        'postpone': Date(mandatory=False)})
+        'all_results': Boolean})
+    action_postpone_schema = freeze(merge_dicts(
+        bulk_schema,
+        postpone=Date(mandatory=False)))
+    action_bulk_assigned_schema = freeze(merge_dicts(
+        bulk_schema,
+        bulk_assigned=AssignedList(mandatory=True)))
+    action_bulk_status_schema = freeze(merge_dicts(
+        bulk_schema,
+        bulk_status=MissionStatus(mandatory=True)))
+    action_bulk_tag_schema = freeze(merge_dicts(
+        bulk_schema,
+        bulk_tag=String(mandatory=True)))
 
     csv_columns = freeze([
         CSVColumn('crm_m_alert', title=MSG(u"Alert")),
@@ -344,91 +481,43 @@ class CRM_SearchMissions(CRM_Search):
         return context.root.search(query)
 
 
-    def get_key_sorted_by_alert(self):
-        today = date.today()
-        def key(item):
-            alert = item.crm_m_alert
-            # No alert
-            if alert is None:
-                return (3, None)
-            alert_date = alert.date()
-            # Present
-            if alert_date == today:
-                return (0, alert)
-            # Future
-            if alert_date > today:
-                return (1, alert)
-            # Past
-            return (2, alert)
-        return key
-
-
-    def get_key_sorted_by_status(self):
-        def key(item):
-            return item.crm_m_status
-        return key
-
-
-    def get_key_sorted_by_nextaction(self):
-        def key(item):
-            return item.crm_m_nextaction.lower().translate(transmap)
-        return key
-
-
-    def get_key_sorted_by_contacts(self):
-        context = get_context()
-        contacts = context.resource.get_resource('contacts')
-        def key(item, cache={}):
-            m_contacts = tuple(item.crm_m_contact)
-            if m_contacts not in cache:
-                value = None
-                for m_contact in m_contacts:
-                    contact = contacts.get_resource(m_contact)
-                    value = contact.get_title().lower().translate(transmap)
-                    break
-                cache[m_contacts] = value
-            return cache[m_contacts]
-        return key
-
-
-    def get_key_sorted_by_company(self):
-        context = get_context()
-        contacts = context.resource.get_resource('contacts')
-        companies = context.resource.get_resource('companies')
-        def key(item, cache={}):
-            m_contacts = tuple(item.crm_m_contact)
-            if m_contacts not in cache:
-                value = None
-                for m_contact in m_contacts:
-                    contact = contacts.get_resource(m_contact)
-                    p_company = contact.get_property('crm_p_company')
-                    company = companies.get_resource(p_company)
-                    value = company.get_title().lower().translate(transmap)
-                    break
-                cache[m_contacts] = value
-            return cache[m_contacts]
-        return key
+    def get_documents_sorted_by_alert(self, results, start, size, reverse):
+        # Present, future, past, then no alert
+        queries = [get_alert_query(period)
+                for period in ('today', 'future', 'past')]
+        queries.append(NotQuery(OrQuery(*queries)))
+        if reverse is True:
+            queries.reverse()
+        # Only fetch the documents of the batch, bucket by bucket
+        items = []
+        for query in queries:
+            bucket = results.search(query)
+            n = len(bucket)
+            if start >= n:
+                start -= n
+                continue
+            if size:
+                bucket_size = size - len(items)
+            else:
+                bucket_size = 0
+            items.extend(bucket.get_documents(sort_by='crm_m_alert',
+                reverse=reverse, start=start, size=bucket_size))
+            start = 0
+            if size and len(items) >= size:
+                break
+        return items
 
 
     def get_key_sorted_by_assigned(self):
         context = get_context()
-        get_user_title = context.root.get_user_title
-        def key(item, cache={}):
-            assigned = item.crm_m_assigned
-            if assigned not in cache:
-                cache[assigned] = get_user_title(assigned)
-            return cache[assigned]
+        def key(item):
+            return get_user_title(context, item.crm_m_assigned)
         return key
 
 
-    def get_item_value(self, resource, context, item, column, cache={}):
+    def get_item_value(self, resource, context, item, column):
         item_brain, item_resource = item
         if column == 'checkbox':
-            parent = item_resource.parent
-            if parent is None:
-                return None
-            if item_resource.name in parent.__fixed_handlers__:
-                return None
             id = resource.get_canonical_path().get_pathto(item_brain.abspath)
             id = str(id)
             return id, False
@@ -443,22 +532,17 @@ class CRM_SearchMissions(CRM_Search):
             # Status
             return ShortStatusIcon(item_brain.crm_m_status)
         elif column in ('contacts', 'contacts_csv'):
-            m_contacts = item_brain.crm_m_contact
-            query = [PhraseQuery('name', name) for name in m_contacts]
-            if len(query) == 1:
-                query = query[0]
-            else:
-                query = OrQuery(*query)
-            crm = get_crm(resource)
-            query = AndQuery(get_crm_path_query(crm), query)
-            query = AndQuery(PhraseQuery('format', 'contact'), query)
-            results = context.root.search(query)
+            # Prefetched by "sort_and_batch"
+            contacts = resource.get_resource('contacts')
+            brains = contacts.get_contacts(item_brain.crm_m_contact,
+                    context).values()
+            brains.sort(key=attrgetter('crm_p_lastname'))
             if column == 'contacts':
                 pattern = u'<a href="{link}">{lastname}<br/>{firstname}</a>'
             else:
                 pattern = u"{lastname} {firstname}"
             names = []
-            for brain in results.get_documents(sort_by='crm_p_lastname'):
+            for brain in brains:
                 link = context.get_link(brain)
                 lastname = brain.crm_p_lastname.upper()
                 firstname = brain.crm_p_firstname
@@ -468,37 +552,197 @@ class CRM_SearchMissions(CRM_Search):
                 return MSG(u"<br/>".join(names), format='html')
             return u"\n".join(names)
         elif column == 'company':
-            contact_id = item_brain.crm_m_contact[0]
-            contact = resource.get_resource('contacts/' + contact_id)
-            p_company = contact.get_property('crm_p_company')
+            p_company = item_brain.crm_m_company
             if not p_company:
                 return u""
-            company = resource.get_resource('companies/' + p_company)
-            title = company.get_title()
-            href = context.get_link(company)
-            return title, href
+            href = '%s/companies/%s' % (context.get_link(resource), p_company)
+            return item_brain.crm_m_company_title, href
         elif column == 'assigned':
             user_id = item_brain.crm_m_assigned
-            return context.root.get_user_title(user_id)
+            return get_user_title(context, user_id)
         return super(CRM_SearchMissions, self).get_item_value(resource,
-                context, item, column, cache=cache)
+                context, item, column)
+
+
+    def sort_and_batch(self, resource, context, results):
+        proxy = super(CRM_SearchMissions, self)
+        items = proxy.sort_and_batch(resource, context, results)
+        # Fetch the contacts of the whole batch at once
+        names = set()
+        for brain, mission in items:
+            names.update(brain.crm_m_contact)
+        if names:
+            contacts = resource.get_resource('contacts')
+            contacts.get_contacts(names, context)
+        return items
+
+
+    def get_namespace(self, resource, context):
+        proxy = super(CRM_SearchMissions, self)
+        namespace = proxy.get_namespace(resource, context)
+        namespace['all_results'] = True
+        return namespace
+
+
+    def get_selected_missions(self, resource, context, form):
+        """ Return the missions checked, or all the missions found when
+            asked to, loaded one at a time.
+        """
+        if form['all_results']:
+            missions = resource.get_resource('missions')
+            results = self.get_items(resource, context)
+            for brain in results.get_documents():
+                yield missions.get_resource(brain.name)
+        else:
+            for path in form['ids']:
+                yield resource.get_resource(path)
+
+
+    def update_missions(self, resource, context, form, update):
+        """ Apply "update" to the selected missions and return the number of
+            missions changed, or None if none was selected.
+
+            "update(mission)" changes the mission and returns the
+            description of the change, or None if there was nothing to
+            change. The missions are indexed once at the end of the
+            transaction, and the users assigned receive a single summary.
+        """
+        username = context.user.name
+        summaries = {}
+        selected = 0
+        n = 0
+        m_contacts = []
+        for mission in self.get_selected_missions(resource, context, form):
+            selected += 1
+            m_contacts.extend(mission.get_property('crm_m_contact'))
+            old_assigned = mission.get_property('crm_m_assigned')
+            change = update(mission)
+            if change is None:
+                continue
+            n += 1
+            uri = context.uri.resolve(context.get_link(mission))
+            line = BULK_LINE.gettext(name=mission.name,
+                    title=mission.get_title(), change=change, uri=uri)
+            assigned = mission.get_property('crm_m_assigned')
+            for to_user in set([old_assigned, assigned]):
+                if to_user and to_user != username:
+                    summaries.setdefault(to_user, []).append(line)
+        if not selected:
+            context.message = ERR_NO_MISSION_SELECTED
+            return None
+        # The missions are indexed again reading their contacts from the
+        # catalog, at once
+        contacts = resource.get_resource('contacts')
+        contacts.prefetch_contacts(m_contacts, context)
+
+        # A single summary by user, gathered in their digest if any
+        if summaries:
+            crm = get_crm(resource)
+            user_title = get_user_title(context, username)
+            for to_user, lines in summaries.iteritems():
+                subject = BULK_SUBJECT.gettext(
+                        crm_title=crm.get_title() or u"CRM", n=len(lines),
+                        user_title=user_title)
+                queue_notification(context, to_user, subject,
+                        u"\n\n".join(lines))
+            send_notifications(context, crm)
+        return n
 
 
     def action_postpone(self, resource, context, form):
         postpone = form['postpone']
+        if postpone is None:
+            context.message = ERR_NO_POSTPONE_DATE
+            return
         alert = datetime.combine(postpone, time(9, 0))
-        pattern = MSG(u'<a href="{path}">{title}</a>', format='replace')
-        missions = []
-        for path in form['ids']:
-            mission = resource.get_resource(path)
+        postpone = context.format_date(postpone)
+
+        def update(mission):
+            if mission.get_property('crm_m_alert') == alert:
+                return None
             mission.set_property('crm_m_alert', alert)
-            missions.append(pattern.gettext(path=path,
-                title=mission.get_title()))
+            return BULK_ALERT.gettext(date=postpone)
 
-        postpone = context.format_date(postpone)
-        missions = u", ".join(missions)
-        context.message = MSG_MISSIONS_POSTPONED(postpone=postpone,
-                missions=missions)
+        n = self.update_missions(resource, context, form, update)
+        if n is not None:
+            context.message = MSG_MISSIONS_POSTPONED(n=n, postpone=postpone)
+
+
+    def action_bulk_assigned(self, resource, context, form):
+        assigned = form['bulk_assigned']
+        if assigned == AssignedList.NOT_ASSIGNED:
+            assigned = ''
+        user_title = get_user_title(context, assigned) if assigned else u""
+
+        def update(mission):
+            if mission.get_property('crm_m_assigned') == assigned:
+                return None
+            mission.set_property('crm_m_assigned', assigned)
+            return BULK_ASSIGNED.gettext(user_title=user_title)
+
+        n = self.update_missions(resource, context, form, update)
+        if n is not None:
+            context.message = MSG_MISSIONS_UPDATED(n=n)
+
+
+    def action_bulk_status(self, resource, context, form):
+        status = form['bulk_status']
+        status_title = MissionStatus.get_value(status)
+
+        def update(mission):
+            if mission.get_property('crm_m_status') == status:
+                return None
+            mission.set_property('crm_m_status', status)
+            return BULK_STATUS.gettext(status=status_title)
+
+        n = self.update_missions(resource, context, form, update)
+        if n is not None:
+            context.message = MSG_MISSIONS_UPDATED(n=n)
+
+
+    def action_bulk_tag(self, resource, context, form):
+        tag = form['bulk_tag']
+        tag_title = TagsList.get_value(tag, tag)
+
+        def update(mission):
+            tags = list(mission.get_property('tags'))
+            if tag in tags:
+                return None
+            tags.append(tag)
+            mission.set_property('tags', tags)
+            return BULK_TAG.gettext(tag=tag_title)
+
+        n = self.update_missions(resource, context, form, update)
+        if n is not None:
+            context.message = MSG_MISSIONS_UPDATED(n=n)
+
+
+
+class CRM_Alerts(CRM_SearchMissions):
+    title = MSG(u'Alerts')
+    template = '/ui/crm/crm/alerts.xml'
+    query_schema = freeze(merge_dicts(
+        CRM_SearchMissions.query_schema,
+        sort_by=String(default='crm_m_alert')))
+
+    search_schema = freeze(merge_dicts(
+        CRM_SearchMissions.search_schema,
+        period=AlertPeriod(mandatory=True, default='due')))
+    search_widgets = freeze(
+            CRM_SearchMissions.search_widgets[:1]
+            + [SelectWidget('period', title=MSG(u"Alerts"),
+                has_empty_option=False)]
+            + CRM_SearchMissions.search_widgets[1:])
+
+    batch_msg1 = MSG(u'1 alert.')
+    batch_msg2 = MSG(u'{n} alerts.')
+
+
+    def get_items(self, resource, context, *args):
+        args = list(args)
+        args.append(get_alert_query(context.query['period']))
+        proxy = super(CRM_Alerts, self)
+        return proxy.get_items(resource, context, *args)
 
 
 
@@ -549,13 +793,6 @@ class CRM_SearchContacts(CRM_Search):
     batch_msg2 = MSG(u'{n} contacts.')
 
 
-    def get_key_sorted_by_title(self):
-        def key(item):
-            return (item.crm_p_lastname.lower().translate(transmap),
-                    item.crm_p_firstname.lower().translate(transmap))
-        return key
-
-
     def get_items(self, resource, context, *args):
         query = self._get_query(resource, context, *args)
         # Insert status filter
@@ -565,24 +802,28 @@ class CRM_SearchContacts(CRM_Search):
             for s in p_status:
                 status_query.append(PhraseQuery('crm_p_status', s))
             query = AndQuery(query, OrQuery(*status_query))
+        # Kept for the aggregates, the view is shared by the requests
+        get_cache(context, 'search')['query'] = query
         # Ok
         return context.root.search(query)
 
 
-    def get_item_value(self, resource, context, item, column, cache={}):
+    def get_item_value(self, resource, context, item, column):
         item_brain, item_resource = item
         if column == 'title':
             value = get_name(item_brain)
-            href = '%s/' % context.get_link(item_resource)
+            href = '%s/' % context.get_link(item_brain)
             return value, href
         elif column == 'company':
             p_company = item_brain.crm_p_company
             if not p_company:
                 return u''
             crm = get_crm(resource)
-            company = crm.get_resource('companies/' + p_company)
-            href = context.get_link(company)
-            title = company.get_title()
+            companies = crm.get_resource('companies')
+            title = companies.get_company_title(p_company, context)
+            if title is None:
+                return u''
+            href = '%s/companies/%s' % (context.get_link(crm), p_company)
             return title, href
         elif column == 'email':
             value = item_brain.crm_p_email
@@ -598,38 +839,45 @@ class CRM_SearchContacts(CRM_Search):
             return format_amount(value, context)
         elif column.startswith('crm_m_'):
             # CSV export
-            contact_name = item_brain.name
-            mission_brain = cache.get(contact_name)
+            mission_name = item_brain.crm_p_last_mission
+            if not mission_name:
+                return None
+            missions = get_crm(resource).get_resource('missions')
+            mission_brain = missions.get_brains([mission_name],
+                    context).get(mission_name)
             if mission_brain is None:
-                crm = get_crm(resource)
-                query = AndQuery(
-                        get_crm_path_query(crm),
-                        PhraseQuery('format', 'mission'),
-                        PhraseQuery('crm_m_contact', item_brain.name))
-                results = context.root.search(query)
-                last_missions = results.get_documents(sort_by='mtime',
-                        reverse=True, size=1)
-                if not last_missions:
-                    return None
-                mission_brain = cache[contact_name] = last_missions[0]
+                return None
             if column == 'crm_m_title':
                 column = 'title'
             return getattr(mission_brain, column)
         proxy = super(CRM_SearchContacts, self)
-        return proxy.get_item_value(resource, context, item, column,
-                cache=cache)
-
+        return proxy.get_item_value(resource, context, item, column)
 
-    def sort_and_batch(self, resource, context, results):
-        # Calculate the probable and assured amount
-        self.assured = dec('0.0')
-        self.probable = dec('0.0')
-        for brain in results.get_documents():
-            self.assured += brain.crm_p_assured
-            self.probable += brain.crm_p_probable
 
+    def get_csv_items(self, resource, context, form):
         proxy = super(CRM_SearchContacts, self)
-        return proxy.sort_and_batch(resource, context, results)
+        missions = get_crm(resource).get_resource('missions')
+        chunk = []
+        for item in proxy.get_csv_items(resource, context, form):
+            chunk.append(item)
+            if len(chunk) == self.csv_chunk_size:
+                for item in self.prefetch_last_missions(missions, context,
+                        chunk):
+                    yield item
+                chunk = []
+        for item in self.prefetch_last_missions(missions, context, chunk):
+            yield item
+
+
+    def prefetch_last_missions(self, missions, context, items):
+        """ Fetch the last missions of the given contacts at once, instead
+            of those of the previous chunk.
+        """
+        missions.clear_brains(context)
+        missions.get_brains([brain.crm_p_last_mission
+            for brain, contact in items if brain.crm_p_last_mission],
+            context)
+        return items
 
 
     def get_namespace(self, resource, context):
@@ -637,11 +885,28 @@ class CRM_SearchContacts(CRM_Search):
         namespace = proxy.get_namespace(resource, context)
         # Add infos about assured and probable amount
         # TODO Filter by year or semester
-        total = self.assured + self.probable
-
-        namespace['assured'] = format_amount(self.assured, context)
-        namespace['probable'] = format_amount(self.probable, context)
+        query = get_cache(context, 'search')['query']
+        aggregates = get_aggregates(context, query,
+                sums=('crm_p_assured', 'crm_p_probable'),
+                counts=('crm_p_status', 'tags'), depends=('contact',))
+        sums = aggregates['sums']
+        assured = sums['crm_p_assured']
+        probable = sums['crm_p_probable']
+        total = assured + probable
+
+        namespace['assured'] = format_amount(assured, context)
+        namespace['probable'] = format_amount(probable, context)
         namespace['total'] = format_amount(total, context)
+        # Number of contacts by status and by tag
+        counts = aggregates['counts']
+        namespace['statuses'] = [
+            {'title': option['value'],
+             'count': counts['crm_p_status'].get(option['name'], 0)}
+            for option in ContactStatus.get_options()
+            if option['name'] in counts['crm_p_status']]
+        namespace['tag_counts'] = [
+            {'title': TagsList.get_value(name, name), 'count': count}
+            for name, count in sorted(counts['tags'].iteritems())]
         namespace['crm-infos'] = True
 
         return namespace
@@ -680,7 +945,7 @@ class CRM_SearchCompanies(CRM_Search):
     batch_msg2 = MSG(u'{n} companies.')
 
 
-    def get_item_value(self, resource, context, item, column, cache={}):
+    def get_item_value(self, resource, context, item, column):
         proxy = super(CRM_SearchCompanies, self)
         item_brain, item_resource = item
         if column == 'address':
@@ -694,8 +959,7 @@ class CRM_SearchCompanies(CRM_Search):
             if value == 'http://':
                 return None
             return value, value
-        return proxy.get_item_value(resource, context, item, column,
-                cache=cache)
+        return proxy.get_item_value(resource, context, item, column)
 
 
 
@@ -754,6 +1018,87 @@ class CRM_Test(STLView):
 
 
 
+class CRM_RepairStatistics(AutoForm):
+    access = 'is_admin'
+    title = MSG(u"Rebuild Statistics")
+    description = MSG(u"Compute again the statistics of the contacts from "
+            u"their missions.")
+    submit_value = MSG(u"Rebuild")
+
+
+    def action(self, resource, context, form):
+        n = resource.rebuild_statistics()
+        context.message = MSG_STATISTICS_REBUILT(n=n)
+
+
+
+class CRM_IndexComments(AutoForm):
+    access = 'is_admin'
+    title = MSG(u"Index Comments")
+    description = MSG(u"Index again the comments, e.g. after the catalog "
+            u"was rebuilt.")
+    submit_value = MSG(u"Index")
+
+
+    def action(self, resource, context, form):
+        n = resource.index_comments()
+        context.message = MSG_COMMENTS_INDEXED(n=n)
+
+
+
+class CRM_Edit(DBResource_Edit):
+    styles = ['/ui/crm/style.css']
+    schema = freeze(merge_dicts(
+        DBResource_Edit.schema,
+        crm_digest_window=Integer(mandatory=True),
+        crm_digest_token=String))
+    widgets = freeze(
+        DBResource_Edit.widgets + [
+        TextWidget('crm_digest_window', size=4,
+            title=MSG(u"Send the notifications of missions together over "
+                u"(minutes, 0 to send them at once)")),
+        TextWidget('crm_digest_token', size=32,
+            title=MSG(u"Secret to send the due digests from cron "
+                u"(empty to disable)"))])
+
+
+
+class CRM_SendDueDigests(BaseView):
+    """ Send the digests whose window is over, without waiting for another
+        notification. To call from cron with the secret of the CRM, e.g.
+        every 5 minutes:
+
+            curl -s -d 'token=SECRET' \
+                'http://example.com/crm/;send_due_digests'
+    """
+    # Checked against the secret of the CRM, cron cannot log in
+    access = True
+
+
+    def POST(self, resource, context):
+        secret = resource.get_property('crm_digest_token')
+        token = context.get_form_value('token')
+        if not secret or token != secret:
+            raise Forbidden
+        n = send_digests(context, resource)
+        context.set_content_type('text/plain')
+        return '%d\n' % n
+
+
+
+class CRM_SendDigests(AutoForm):
+    access = 'is_admin'
+    title = MSG(u"Send Digests")
+    description = MSG(u"Send the notifications waiting for the digest now.")
+    submit_value = MSG(u"Send")
+
+
+    def action(self, resource, context, form):
+        n = send_digests(context, resource, force=True)
+        context.message = MSG_DIGESTS_SENT(n=n)
+
+
+
 import_columns = freeze({
     GMAIL_LAST_NAME: 'crm_p_lastname',
     GMAIL_FIRST_NAME: 'crm_p_firstname',
@@ -763,6 +1108,137 @@ import_columns = freeze({
     GMAIL_MOBILE_PHONE: 'crm_p_mobile'})
 
 
+class ContactsImport(object):
+    """ Import contacts in bulk: the companies and contacts of the CRM are
+        read from the catalog once, and the rows are matched against them in
+        memory, on their case and accent independent values. The names of
+        the new resources are reserved in blocks, for the rows still to
+        import.
+    """
+
+    def __init__(self, crm, context, n_rows=0):
+        self.language = context.site_root.get_default_language()
+        self.companies = crm.get_resource('companies')
+        self.contacts = crm.get_resource('contacts')
+        self.added = []
+        self.updated = []
+        self.seen = set()
+        self.n_rows = n_rows
+        self.codes = {}
+
+        root = context.root
+        crm_path_query = get_crm_path_query(crm)
+        # Companies by title
+        self.companies_by_title = {}
+        query = AndQuery(crm_path_query, PhraseQuery('format', 'company'))
+        for brain in root.search(query).get_documents():
+            key = get_sort_value(brain.title)
+            self.companies_by_title.setdefault(key, brain.name)
+        # Contacts by name, with and without their company
+        self.contacts_by_name = {}
+        query = AndQuery(crm_path_query, PhraseQuery('format', 'contact'))
+        for brain in root.search(query).get_documents():
+            self.add_contact_key(brain.name, brain.crm_p_firstname,
+                    brain.crm_p_lastname, brain.crm_p_email,
+                    brain.crm_p_company)
+
+
+    def get_email_key(self, email):
+        """ Return the e-mail as lower case unicode, to compare.
+        """
+        if not email:
+            return u''
+        if type(email) is str:
+            email = email.decode('utf_8')
+        return email.strip().lower()
+
+
+    def add_contact_key(self, name, firstname, lastname, email, company):
+        firstname = get_sort_value(firstname)
+        lastname = get_sort_value(lastname)
+        value = (self.get_email_key(email), name)
+        for p_company in set([company or None, None]):
+            key = (firstname, lastname, p_company)
+            self.contacts_by_name.setdefault(key, []).append(value)
+
+
+    def get_code(self, container):
+        """ Return a name reserved for a new resource of the container.
+        """
+        codes = self.codes.setdefault(container.get_abspath(), [])
+        if not codes:
+            codes.extend(container.reserve_codes(max(self.n_rows + 1, 1)))
+        return codes.pop(0)
+
+
+    def get_company(self, title):
+        """ Return the name of the company with this title, created if not
+            found.
+        """
+        key = get_sort_value(title)
+        name = self.companies_by_title.get(key)
+        if name is None:
+            company = self.companies.add_company(
+                    name=self.get_code(self.companies),
+                    title={self.language: title})
+            name = company.name
+            self.companies_by_title[key] = name
+        return name
+
+
+    def find_contact(self, firstname, lastname, email, company):
+        """ Return the name of the contact with this name and company, and
+            e-mail if given.
+        """
+        key = (get_sort_value(firstname), get_sort_value(lastname), company)
+        email = self.get_email_key(email)
+        for p_email, name in self.contacts_by_name.get(key, []):
+            if not email or p_email == email:
+                return name
+        return None
+
+
+    def import_row(self, values, company_title=None):
+        self.n_rows -= 1
+        cls = get_resource_class('contact')
+        # Encode values
+        for name, value in values.iteritems():
+            if issubclass(cls.class_schema[name], String):
+                values[name] = value.encode('utf_8')
+        # Find company
+        company = None
+        if company_title:
+            company = self.get_company(company_title)
+        # Find contact by name and company if available
+        firstname = values.get('crm_p_firstname')
+        lastname = values.get('crm_p_lastname')
+        email = values.get('crm_p_email')
+        name = self.find_contact(firstname, lastname, email, company)
+        if name is None:
+            # Creating contact with all its values at once
+            contact = self.contacts.add_contact(
+                    name=self.get_code(self.contacts), crm_p_company=company,
+                    crm_p_status='lead', **values)
+            name = contact.name
+            self.add_contact_key(name, firstname, lastname, email, company)
+            self.added.append(contact)
+            self.seen.add(name)
+            return contact
+
+        # Update contact
+        contact = self.contacts.get_resource(name)
+        for key, value in values.iteritems():
+            if key in ('crm_p_firstname', 'crm_p_lastname', 'crm_p_email'):
+                continue
+            if contact.get_property(key) != value:
+                contact.set_property(key, value)
+        if name not in self.seen:
+            self.updated.append(contact)
+            self.seen.add(name)
+        return contact
+
+
+
 class ColumnsWidget(Widget):
     template = make_stl_template("Known columns (no order required): "
             + ", ".join(c.encode('utf_8') for c in import_columns))
@@ -795,92 +1271,23 @@ class CRM_ImportContacts(AutoForm):
 
         # Decode header
         header = rows.next()
+        columns = dict([(title, i) for i, title in enumerate(header)])
 
-        root = context.root
-        language = context.site_root.get_default_language()
-        companies = resource.get_resource('companies')
-        contacts = resource.get_resource('contacts')
-        abspath = str(resource.get_canonical_path())
-        base_path_query = get_base_path_query(abspath)
-
-        contacts_added = {}
-        contacts_updated = []
-        companies_added = {}
-
+        rows = list(rows)
+        contacts_import = ContactsImport(resource, context, len(rows))
         for row in rows:
-            # Find company
-            company_title = find_value_by_column(header, row, GMAIL_COMPANY)
-            if company_title:
-                company = None
-                # FIXME the catalog should do this
-                key = company_title.lower().translate(transmap)
-                if key in companies_added:
-                    # Already added
-                    company = companies_added[key]
-                else:
-                    # Search existing company
-                    query = AndQuery(base_path_query,
-                                PhraseQuery('format', 'company'),
-                                TextQuery('title', company_title))
-                    results = root.search(query)
-                    for document in results.get_documents():
-                        # Found
-                        company = root.get_resource(document.abspath)
-                        break
-                    else:
-                        # Creating company
-                        company = companies.add_company(
-                                title={language: company_title})
-                        companies_added[key] = company
-            else:
-                company = thingy(name=None)
-            # Find contact by name and company if available
-            contact = None
-            firstname = find_value_by_column(header, row, GMAIL_FIRST_NAME)
-            lastname = find_value_by_column(header, row, GMAIL_LAST_NAME)
-            email = find_value_by_column(header, row, GMAIL_EMAIL)
-            key = (firstname, lastname, email, company_title)
-            if key in contacts_added:
-                # Already added
-                contact = contacts_added[key]
-            else:
-                # Search existing contact
-                query = AndQuery(base_path_query,
-                            PhraseQuery('format', 'contact'))
-                if firstname:
-                    query.append(TextQuery('crm_p_firstname', firstname))
-                if lastname:
-                    query.append(TextQuery('crm_p_lastname', lastname))
-                if email:
-                    query.append(TextQuery('crm_p_email', email))
-                if company.name is not None:
-                    query.append(PhraseQuery('crm_p_company', company.name))
-                results = root.search(query)
-                for document in results.get_documents():
-                    # Found
-                    contact = root.get_resource(document.abspath)
-                    contacts_updated.append(contact)
-                    break
-                else:
-                    # Creating contact
-                    contact = contacts.add_contact(
-                            crm_p_firstname=firstname,
-                            crm_p_lastname=lastname,
-                            crm_p_email=email,
-                            crm_p_company=company.name,
-                            crm_p_status='lead')
-                    contacts_added[key] = contact
-            # Update contact
+            values = {}
             for title, name in import_columns.iteritems():
-                if title in (GMAIL_FIRST_NAME, GMAIL_LAST_NAME, GMAIL_EMAIL,
-                        GMAIL_COMPANY):
-                    continue
-                value = find_value_by_column(header, row, title)
-                if value is not None:
-                    datatype = contact.get_property_datatype(name)
-                    if issubclass(datatype, String):
-                        value = value.encode('utf8')
-                    contact.set_property(name, value)
+                i = columns.get(title)
+                if i is not None:
+                    values[name] = unicode(row[i], 'utf_8')
+            company_title = None
+            i = columns.get(GMAIL_COMPANY)
+            if i is not None:
+                company_title = unicode(row[i], 'utf_8')
+            contacts_import.import_row(values, company_title)
+        contacts_added = contacts_import.added
+        contacts_updated = contacts_import.updated
 
         message = []
         pattern = u'<a href="{0}">{1}</a>'
@@ -889,7 +1296,7 @@ class CRM_ImportContacts(AutoForm):
             contacts_added = u", ".join(pattern.format(
                 context.get_link(contact),
                 XMLContent.encode(contact.get_title()))
-                for contact in contacts_added.itervalues())
+                for contact in contacts_added)
             message.append(MSG_CONTACTS_ADDED(n=n, added=contacts_added))
         if contacts_updated:
             n = len(contacts_updated)
@@ -22,7 +22,6 @@ import csv
 # Import from itools
 from itools.core import freeze, is_thingy, merge_dicts, thingy, OrderedDict
 from itools.core import guess_type
-from itools.csv import CSVFile
 from itools.datatypes import Enumerate, String
 from itools.gettext import MSG
 from itools.stl import stl
@@ -70,16 +69,6 @@ def cleanup_gmail_csv(body):
 
 
 
-def find_value_by_column(header, row, title, cache={}):
-    if title in cache:
-        return unicode(row[cache[title]], 'utf_8')
-    for i, column in enumerate(header):
-        if column == title:
-            cache[title] = i
-            return unicode(row[i], 'utf_8')
-
-
-
 class CSVColumn(thingy):
     datatype = String
 
@@ -119,6 +108,8 @@ def register_csv_writer(writer, name=None):
 
 
 class CSV_ODS_Writer(thingy):
+    """Rows are encoded as soon as they are added.
+    """
     name = 'ooo'
     title = MSG(u"CSV for OpenOffice.org / LibreOffice")
     mimetype = 'text/comma-separated-values'
@@ -130,11 +121,12 @@ class CSV_ODS_Writer(thingy):
 
     def __init__(cls, columns, name):
         cls.columns = columns
-        cls.csv = CSVFile()
+        cls.nrows = 0
+        cls.buffer = StringIO()
 
 
     def get_nrows(cls):
-        return cls.csv.get_nrows()
+        return cls.nrows
 
 
     def add_row(cls, row, is_header=False):
@@ -146,12 +138,15 @@ class CSV_ODS_Writer(thingy):
                 value = value.encode(cls.encoding)
             else:
                 value = str(value)
-            values.append(value)
-        cls.csv.add_row(values)
+            values.append('"%s"' % value.replace('"', '""'))
+        if cls.nrows:
+            cls.buffer.write(cls.newline)
+        cls.buffer.write(cls.separator.join(values))
+        cls.nrows += 1
 
 
     def to_str(cls):
-        return cls.csv.to_str(separator=cls.separator, newline=cls.newline)
+        return cls.buffer.getvalue()
 
 register_csv_writer(CSV_ODS_Writer)
 
@@ -335,6 +330,8 @@ class CSV_Export(object):
     csv_table_name = MSG(u"Sheet1")
     csv_filename = None
     csv_allow_empty = False
+    # Number of items prepared at once, e.g. to prefetch related brains
+    csv_chunk_size = 500
 
 
     def get_csv_namespace(self, resource, context):
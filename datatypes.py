@@ -16,14 +16,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-# Import from the Standard Library
-from operator import itemgetter
-
 # Import from itools
 from itools.core import thingy_property
 from itools.datatypes import Enumerate
 from itools.gettext import MSG
-from itools.handlers.utils import transmap
 from itools.web import get_context
 
 # Import from ikaaro
@@ -41,28 +37,30 @@ from utils import get_crm
 class CompanyName(Enumerate):
 
     @classmethod
-    def get_options(cls):
+    def get_companies(cls):
         context = get_context()
-        crm = get_crm(context.resource)
-        parent_path = '%s/companies' % crm.get_abspath()
-        root = context.root
-        results = root.search(format='company', parent_path=parent_path)
-        options = []
-        # FIXME catalog case-independant sort
-        for brain in results.get_documents():
-            value = brain.title
-            # Reduce the length of the title
-            if len(value) > 63:
-                value = '%s...%s' % (value[:30], value[-30:])
-            options.append({
-                'name': brain.name,
-                'value': value,
-                'sort_value': value.lower().translate(transmap)})
-
-        # FIXME move hack to a catalog index
-        options.sort(key=itemgetter('sort_value'))
+        return get_crm(context.resource).get_resource('companies')
+
+
+    @classmethod
+    def get_options(cls):
+        companies = cls.get_companies()
+        return companies.get_company_options(get_context())
 
-        return options
+
+    @classmethod
+    def is_valid(cls, name):
+        companies = cls.get_companies()
+        return companies.get_company_title(name, get_context()) is not None
+
+
+    @classmethod
+    def get_value(cls, name, default=None):
+        companies = cls.get_companies()
+        title = companies.get_company_title(name, get_context())
+        if title is None:
+            return default
+        return title
 
 
 
@@ -84,6 +82,15 @@ class MissionStatusShortened(Enumerate):
 
 
 
+class AlertPeriod(Enumerate):
+    options = [
+        {'name': 'due', 'value': MSG(u"Due")},
+        {'name': 'past', 'value': MSG(u"Overdue")},
+        {'name': 'today', 'value': MSG(u"Today")},
+        {'name': 'future', 'value': MSG(u"Upcoming")}]
+
+
+
 class ContactStatus(Enumerate):
     options = [
         {'name': 'lead', 'value': MSG(u"Lead")},
@@ -95,19 +102,33 @@ class ContactStatus(Enumerate):
 class ContactName(Enumerate):
 
     @classmethod
-    def get_options(cls):
+    def get_contacts(cls):
         context = get_context()
-        crm = get_crm(context.resource)
-        parent_path = '%s/contacts' % crm.get_abspath()
-        root = context.root
-        results = root.search(format='contact', parent_path=parent_path)
-        options = []
-        for brain in results.get_documents(sort_by='crm_p_lastname'):
-            options.append({
-                'name': brain.name,
-                'value': brain.title})
+        return get_crm(context.resource).get_resource('contacts')
 
-        return options
+
+    @classmethod
+    def get_options(cls):
+        """ Too many to list, the contacts are picked with the type-ahead
+            of Contacts.search_contacts.
+        """
+        return []
+
+
+    @classmethod
+    def is_valid(cls, name):
+        # Look up the contact instead of listing them all
+        contacts = cls.get_contacts()
+        return name in contacts.get_contacts([name], get_context())
+
+
+    @classmethod
+    def get_value(cls, name, default=None):
+        contacts = cls.get_contacts()
+        brain = contacts.get_contacts([name], get_context()).get(name)
+        if brain is None:
+            return default
+        return brain.title
 
 
 
@@ -14,6 +14,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# Import from the Standard Library
+from operator import attrgetter
+
 # Import from itools
 from itools.core import thingy
 from itools.database import OrQuery, PhraseQuery, AndQuery
@@ -26,6 +29,7 @@ from ikaaro.utils import CMSTemplate
 # Import from crm
 from base_views import Icon, StatusIcon
 from utils import get_crm, get_crm_path_query, get_contact_title
+from utils import get_cached_resource
 
 
 class item(thingy):
@@ -98,8 +102,9 @@ class ContactsMenu(ContextMenu):
                 selected=False))
             m_contact = resource.get_property('crm_m_contact')
             if m_contact:
-                contacts = resource.get_resource('../../contacts')
-                contact = contacts.get_resource(m_contact[0])
+                contact = get_cached_resource(context,
+                        resource.get_abspath().resolve2('../../contacts/%s'
+                            % m_contact[0]))
                 p_company = contact.get_property('crm_p_company')
                 items.append(item(
                     title=MSG(u"New Contact"),
@@ -178,16 +183,18 @@ class MissionsMenu(ContextMenu):
         context = get_context()
         resource = context.resource
         abspath = resource.abspath
-        root = context.root
         contact_names = [brain.name
                 for brain in self.contact_menu.get_contacts(context)]
-        query = AndQuery(self.contact_menu.get_crm_path_query(context),
-                PhraseQuery('format', 'mission'),
-                OrQuery(*[PhraseQuery('crm_m_contact', contact)
-                    for contact in contact_names]))
-        results = root.search(query)
+        contacts = get_crm(resource).get_resource('contacts')
+        missions = {}
+        for brains in contacts.get_missions(contact_names,
+                context).itervalues():
+            for brain in brains:
+                missions[brain.abspath] = brain
+        missions = missions.values()
+        missions.sort(key=attrgetter('mtime'), reverse=True)
         items = []
-        for brain in results.get_documents(sort_by='mtime', reverse=True):
+        for brain in missions:
             selected = False
             if resource.class_id == 'mission':
                 selected = brain.abspath == abspath
@@ -232,15 +239,17 @@ class CompaniesMenu(ContextMenu):
                 if p_company:
                     todo.append(p_company)
             elif resource.class_id == 'mission':
-                contacts = resource.get_resource('../../contacts')
+                contacts = resource.get_abspath().resolve2('../../contacts')
                 for m_contact in resource.get_property('crm_m_contact'):
-                    contact = contacts.get_resource(m_contact)
+                    contact = get_cached_resource(context,
+                            contacts.resolve2(m_contact))
                     p_company = contact.get_property('crm_p_company')
                     if p_company not in todo:
                         todo.append(p_company)
             companies = resource.get_resource('../../companies')
             for p_company in todo:
-                company = companies.get_resource(p_company)
+                company = get_cached_resource(context,
+                        companies.get_abspath().resolve2(p_company))
                 items.append(item(
                     title=company.get_property('title'),
                     icon=Icon('crm16-company'),
@@ -22,21 +22,23 @@ from itools.core import merge_dicts, freeze
 from itools.datatypes import Date, DateTime, Decimal, Integer
 from itools.datatypes import String, Unicode
 from itools.gettext import MSG
+from itools.web import get_context
 
 # Import from ikaaro
 from ikaaro.comments import comment_datatype
-from ikaaro.folder import Folder
 from ikaaro.folder_views import Folder_BrowseContent
 
 # Import from crm
-from base import CRMFolder
-from base_views import Comments_View
+from base import CRMContainer, CRMFolder
+from base_views import Comments_More, Comments_View
+from cache import get_cache
+from contact import format_contact_title
 from mission_views import Mission_Add, Mission_AddForm, Mission_EditForm
 from mission_views import Mission_View, Mission_ViewContacts
 from mission_views import Mission_EditContacts, Mission_AddContacts
 from mission_views import Mission_ViewContact
 from datatypes import MissionStatus
-from utils import generate_code
+from utils import get_mission_statistics, get_sort_value
 
 
 class Mission(CRMFolder):
@@ -45,7 +47,7 @@ class Mission(CRMFolder):
         - documents related to comments
     """
     class_id = 'mission'
-    class_version = '20100927'
+    class_version = '20111020'
     class_icon16 = 'crm/icons/16x16/mission.png'
     class_icon48 = 'crm/icons/48x48/mission.png'
     class_title = MSG(u'Mission')
@@ -61,15 +63,26 @@ class Mission(CRMFolder):
         crm_m_amount=Decimal(source='metadata', stored=True),
         crm_m_probability=Integer(source='metadata', stored=True),
         crm_m_deadline=Date(source='metadata', stored=True),
-        crm_m_alert=DateTime(source='metadata', indexed=False, stored=True),
+        crm_m_alert=DateTime(source='metadata', indexed=True, stored=True),
         crm_m_nextaction=Unicode(source='metadata', indexed=False,
             stored=True),
+        # Copied from the first contact to sort and display without loading it
+        crm_m_contact_title=Unicode(stored=True),
+        crm_m_company=String(stored=True),
+        crm_m_company_title=Unicode(stored=True),
+        # Sort keys
+        crm_m_sort_nextaction=Unicode(stored=True),
+        crm_m_sort_contact=Unicode(stored=True),
+        crm_m_sort_company=Unicode(stored=True),
         comment=comment_datatype(parameters_schema=merge_dicts(
             comment_datatype.parameters_schema,
             attachment=String))))
     class_sprite16 = 'crm16-mission'
     class_views = (['view', 'add_contacts', 'edit_contacts', 'edit_alerts']
             + CRMFolder.class_views_shortcuts)
+    # The statistics of the contacts depend on these properties
+    statistics_fields = ('crm_m_contact', 'crm_m_status', 'crm_m_amount',
+            'crm_m_probability')
 
     # Views
     add_contacts = Mission_AddContacts()
@@ -79,6 +92,7 @@ class Mission(CRMFolder):
     preview_content = None
     view = Mission_View()
     view_comments = Comments_View()
+    more_comments = Comments_More()
     view_contacts = Mission_ViewContacts()
 
 
@@ -90,32 +104,162 @@ class Mission(CRMFolder):
         title = self.get_property('title')
         description = self.get_property('description')
         nextaction  = self.get_property('crm_m_nextaction')
-        # Index all comments as 'text'
+        document['crm_m_sort_nextaction'] = get_sort_value(nextaction)
+        # Index the small fields as 'text', the comments apart
         values = [title or u'',
                   description or u'',
                   nextaction or u'']
         m_contacts = self.get_property('crm_m_contact')
-        contacts = self.parent.parent.get_resource('contacts')
-        for m_contact in m_contacts:
-            contact = contacts.get_resource(m_contact)
-            values.append(contact.get_property('crm_p_lastname'))
-            values.append(contact.get_property('crm_p_firstname'))
-            title = contact.get_property('title')
-            if title:
-                values.append(title)
-        # Comment
-        values.extend(self.get_property('comment'))
+        crm = self.parent.parent
+        contacts = crm.get_resource('contacts')
+        companies = crm.get_resource('companies')
+        # Read the contacts from the catalog, and load only those changed
+        context = get_context()
+        brains = {}
+        if context is not None:
+            brains = contacts.get_unchanged_brains(m_contacts, context)
+        for i, m_contact in enumerate(m_contacts):
+            brain = brains.get(m_contact)
+            if brain is None:
+                contact = contacts.get_resource(m_contact)
+                lastname = contact.get_property('crm_p_lastname')
+                firstname = contact.get_property('crm_p_firstname')
+                p_company = contact.get_property('crm_p_company')
+            else:
+                lastname = brain.crm_p_lastname
+                firstname = brain.crm_p_firstname
+                p_company = brain.crm_p_company
+            values.append(lastname)
+            values.append(firstname)
+            if i > 0:
+                continue
+            # Index the first contact and its company
+            company_title = None
+            if p_company:
+                if (context is not None
+                        and not companies.is_changed(p_company, context)):
+                    company_title = companies.get_company_title(p_company,
+                            context)
+                if company_title is None:
+                    company = companies.get_resource(p_company, soft=True)
+                    if company is not None:
+                        company_title = company.get_title()
+                if company_title is not None:
+                    document['crm_m_company'] = p_company
+                    document['crm_m_company_title'] = company_title
+                    document['crm_m_sort_company'] = get_sort_value(
+                            company_title)
+            contact_title = format_contact_title(lastname, firstname,
+                    company_title)
+            document['crm_m_contact_title'] = contact_title
+            document['crm_m_sort_contact'] = get_sort_value(contact_title)
         document['text'] = u' '.join(values)
         return document
 
 
+    def set_property(self, name, value, language=None):
+        proxy = super(Mission, self)
+        old_contacts = self.get_property('crm_m_contact')
+        if name in self.statistics_fields:
+            # Report the difference to the statistics of the contacts
+            old_statistics = self.get_statistics()
+            result = proxy.set_property(name, value, language=language)
+            self.update_contacts_statistics(old_contacts, old_statistics,
+                    self.get_property('crm_m_contact'),
+                    self.get_statistics())
+        else:
+            result = proxy.set_property(name, value, language=language)
+        # Modified now, so the last modified mission of its contacts, as
+        # "rebuild_statistics" finds by "mtime"; once by transaction unless
+        # the contacts change
+        new_contacts = self.get_property('crm_m_contact')
+        updated = get_cache(get_context(), 'last_mission_updated')
+        path = str(self.get_abspath())
+        if new_contacts != old_contacts or updated.get(path) != new_contacts:
+            self.update_contacts_last_mission(old_contacts, new_contacts)
+            updated[path] = new_contacts
+        return result
+
+
     #############################################
     # CRM API
     #############################################
+    def get_statistics(self):
+        get_property = self.get_property
+        return get_mission_statistics(get_property('crm_m_status'),
+                get_property('crm_m_amount'),
+                get_property('crm_m_probability'))
+
+
+    def update_contacts_statistics(self, old_contacts, old_statistics,
+            new_contacts, new_statistics):
+        # Sum the differences by contact
+        deltas = {}
+        for contacts, statistics, sign in (
+                (old_contacts, old_statistics, -1),
+                (new_contacts, new_statistics, 1)):
+            for contact in contacts:
+                delta = deltas.setdefault(contact, {})
+                for key, value in statistics.iteritems():
+                    delta[key] = delta.get(key, 0) + sign * value
+        # Apply them
+        contacts = self.parent.parent.get_resource('contacts')
+        for name, delta in deltas.iteritems():
+            delta = dict([(key, value) for key, value in delta.iteritems()
+                if value])
+            if not delta:
+                continue
+            contact = contacts.get_resource(name, soft=True)
+            if contact is None:
+                continue
+            contact.update_statistics(delta)
+
+
+    def update_contacts_last_mission(self, old_contacts, new_contacts):
+        contacts = self.parent.parent.get_resource('contacts')
+        name = self.name
+        for contact_name in new_contacts:
+            contact = contacts.get_resource(contact_name, soft=True)
+            if contact is None:
+                continue
+            if contact.get_property('crm_p_last_mission') != name:
+                contact.set_property('crm_p_last_mission', name)
+        # Removed from the mission
+        context = get_context()
+        for contact_name in set(old_contacts).difference(new_contacts):
+            contact = contacts.get_resource(contact_name, soft=True)
+            if contact is None:
+                continue
+            if contact.get_property('crm_p_last_mission') == name:
+                contact.set_property('crm_p_last_mission',
+                        contact.get_first_mission(context, exclude=name))
+
+
+    def join_contacts(self):
+        """ Add the mission to the statistics and last mission of its
+            contacts, e.g. once copied or moved.
+        """
+        m_contact = self.get_property('crm_m_contact')
+        self.update_contacts_statistics((), {}, m_contact,
+                self.get_statistics())
+        self.update_contacts_last_mission((), m_contact)
+
+
+    def leave_contacts(self):
+        """ Remove the mission from the statistics and last mission of its
+            contacts, e.g. before it is deleted or moved.
+        """
+        m_contact = self.get_property('crm_m_contact')
+        self.update_contacts_statistics(m_contact, self.get_statistics(),
+                (), {})
+        self.update_contacts_last_mission(m_contact, ())
+
+
     def get_last_comment(self):
-        comments = self.metadata.get_property('comment') or []
-        if comments:
-            return comments[-1]
+        log = self.get_comments_log()
+        n = log.get_n_comments()
+        if n:
+            return log.get_comment(n - 1)
         return None
 
 
@@ -123,13 +267,14 @@ class Mission(CRMFolder):
 ###################################
 # Container                       #
 ###################################
-class Missions(Folder):
+class Missions(CRMContainer):
     """ Container of "mission" resources. """
     class_id = 'missions'
     class_title = MSG(u'Missions')
 
     class_views = ['new_mission', 'browse_content']
     class_document_types = [Mission]
+    class_code_format = 'm%06d'
 
     # Views
     add_form = Mission_AddForm()
@@ -139,6 +284,37 @@ class Missions(Folder):
 
 
     def add_mission(self, **kw):
-        names = self.get_names()
-        name = generate_code(names, 'm%06d')
+        name = self.generate_code()
         return self.make_resource(name, Mission, **kw)
+
+
+    def del_resource(self, name, soft=False, **kw):
+        mission = self.get_resource(name, soft=soft)
+        if mission is not None:
+            mission.leave_contacts()
+        proxy = super(Missions, self)
+        return proxy.del_resource(name, soft=soft, **kw)
+
+
+    def copy_resource(self, source_path, target_path, **kw):
+        proxy = super(Missions, self)
+        result = proxy.copy_resource(source_path, target_path, **kw)
+        # The copy counts in the statistics of its contacts
+        mission = self.get_resource(target_path, soft=True)
+        if isinstance(mission, Mission):
+            mission.join_contacts()
+        return result
+
+
+    def move_resource(self, source_path, target_path, **kw):
+        # Leave the contacts where it was, e.g. another CRM
+        mission = self.get_resource(source_path, soft=True)
+        if isinstance(mission, Mission):
+            mission.leave_contacts()
+        proxy = super(Missions, self)
+        result = proxy.move_resource(source_path, target_path, **kw)
+        # Join the contacts where it is now, under its new name
+        mission = self.get_resource(target_path, soft=True)
+        if isinstance(mission, Mission):
+            mission.join_contacts()
+        return result
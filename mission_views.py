@@ -51,7 +51,8 @@ from base_views import get_alert_icon
 from crm_views import CRM_SearchContacts
 from datatypes import MissionStatus, ContactName
 from menus import MissionsMenu, ContactsByMissionMenu, CompaniesMenu
-from utils import get_crm
+from notifications import queue_notification, send_notifications
+from utils import get_crm, get_user_title, NoResults
 from views import TagsAware_Edit
 from widgets import TimeWidget
 
@@ -118,7 +119,6 @@ mission_widgets = freeze(
 
 
 def get_changes(resource, context, form, new=False):
-    root = context.root
     changes = []
     last_comment = resource.get_last_comment()
     for key, datatype in mission_schema.iteritems():
@@ -160,37 +160,25 @@ def get_changes(resource, context, form, new=False):
         title = widget.title.gettext()
         # Special cases for complex objects
         if key == 'crm_m_assigned':
+            removed = u""
             if old_value:
-                removed = old_value
-                user = root.get_user(old_value)
-                if user is not None:
-                    removed = user.get_title()
-            else:
-                removed = u""
+                removed = get_user_title(context, old_value)
+            added = u""
             if new_value:
-                added = new_value
-                user = root.get_user(new_value)
-                if user is not None:
-                    added = user.get_title()
-            else:
-                added = u""
+                added = get_user_title(context, new_value)
             changes.append(CHANGES_LINE.gettext(what=title, removed=removed,
                 added=added))
         elif key == 'crm_m_cc':
             what = title
             for removed in (set(old_value) - set(new_value)):
-                user = root.get_user(removed)
-                if user is not None:
-                    removed = user.get_title()
+                removed = get_user_title(context, removed)
                 changes.append(CHANGES_LINE.gettext(what=what,
                     removed=removed, added=u""))
                 # Show title only once
                 what = u""
             what = title
             for added in (set(new_value) - set(old_value)):
-                user = root.get_user(added)
-                if user is not None:
-                    added = user.get_title()
+                added = get_user_title(context, added)
                 changes.append(CHANGES_LINE.gettext(what=what,
                     removed=u"", added=added))
                 # Show title only once
@@ -234,7 +222,7 @@ def get_changes(resource, context, form, new=False):
 def send_notification(resource, context, form, changes, new=False):
     # From
     user = context.user
-    user_title = user.get_title()
+    user_title = get_user_title(context, user.name)
     user_email = user.get_property('email')
     # To
     to_addrs = set(form['crm_m_cc'])
@@ -261,7 +249,7 @@ def send_notification(resource, context, form, changes, new=False):
     # New comment
     comment = u""
     if form.get('comment'):
-        n = len(resource.get_property('comment')) - 1
+        n = resource.get_comments_log().get_n_comments() - 1
         now = context.format_datetime(context.timestamp)
         comment = [COMMENT_LINE.gettext(n=n, user_title=user_title,
             user_email=user_email, date=now)]
@@ -274,14 +262,9 @@ def send_notification(resource, context, form, changes, new=False):
             mission_name=mission_name, mission_title=mission_title,
             user_title=user_title, user_email=user_email, changes=changes,
             comment=comment)
-    # Send
-    root = context.root
+    # Send at the end of the request
     for to_addr in to_addrs:
-        user = root.get_user(to_addr)
-        if not user:
-            continue
-        to_addr = user.get_property('email')
-        root.send_email(to_addr, subject, text=body)
+        queue_notification(context, to_addr, subject, body)
 
 
 
@@ -388,15 +371,12 @@ class Mission_EditForm(TagsAware_Edit, DBResource_Edit):
         if is_thingy(context.message, ERROR):
             return
 
-        # Reindex contacts to update Opp/Proj/NoGo, p_assured and p_probable
-        crm = get_crm(resource)
-        contacts = crm.get_resource('contacts')
-        for contact_id in resource.get_property('crm_m_contact'):
-            contact = contacts.get_resource(contact_id)
-            context.database.change_resource(contact)
+        # Contacts statistics (Opp/Proj/NoGo, p_assured and p_probable) are
+        # updated by the mission itself
 
         # Send notification to CC
         send_notification(resource, context, form, changes, new=new)
+        send_notifications(context, get_crm(resource))
 
 
     def set_value(self, resource, context, name, form):
@@ -451,8 +431,7 @@ class Mission_EditForm(TagsAware_Edit, DBResource_Edit):
             author = user.name if user else None
             value = Property(value, date=context.timestamp, author=author,
                     attachment=attachment)
-            resource.metadata.set_property(name, value)
-            context.database.change_resource(resource)
+            resource.set_property(name, value)
             return False
         proxy = DBResource_Edit
         return proxy.set_value(self, resource, context, name, form)
@@ -564,7 +543,8 @@ class Mission_EditContacts(Mission_ViewContacts):
             context.message = ERR_CONTACT_MANDATORY
             return
 
-        # Apply change
+        # Apply change, the removed contacts are updated (statistics, last
+        # mission) and so indexed again at the end of the transaction
         resource.set_property('crm_m_contact', m_contact)
         context.message = MSG_CHANGES_SAVED
 
@@ -576,6 +556,7 @@ class Mission_AddContacts(CRM_SearchContacts):
     schema = freeze({
         'ids': String(multiple=True, mandatory=True)})
     search_template = '/ui/crm/mission/search_contacts.xml'
+    scripts = ['/ui/crm/javascript.js']
     table_actions = freeze([
         ButtonAddContact])
     csv_columns = None
@@ -625,11 +606,23 @@ class Mission_AddContacts(CRM_SearchContacts):
         else:
             p_company = company.name
         namespace['p_company'] = p_company
+        crm = get_crm(resource)
+        namespace['search_url'] = '%s/contacts/;search_json' % (
+                context.get_link(crm))
         return namespace
 
 
-    def get_namespace(self, resource, context):
+    def get_items(self, resource, context, *args):
+        if not context.query['search_term'].strip():
+            # Pick with the type-ahead instead of paging every contact
+            return NoResults()
         proxy = super(Mission_AddContacts, self)
+        return proxy.get_items(resource, context, *args)
+
+
+    def get_namespace(self, resource, context):
+        # Skip the amounts of the contacts found, not shown here
+        proxy = super(CRM_SearchContacts, self)
         namespace = proxy.get_namespace(resource, context)
         namespace['crm-infos'] = False
         namespace['export-csv'] = False
@@ -640,15 +633,9 @@ class Mission_AddContacts(CRM_SearchContacts):
         # Save changes
         m_contact = resource.get_property('crm_m_contact')
         m_contact = list(set(m_contact + form['ids']))
+        # The new contacts get the mission in their statistics
         resource.set_property('crm_m_contact', m_contact)
 
-        # Reindex contacts so they know about the mission
-        crm = get_crm(resource)
-        contacts = crm.get_resource('contacts')
-        for contact_id in form['ids']:
-            contact = contacts.get_resource(contact_id)
-            context.database.change_resource(contact)
-
         context.message = MSG_CONTACT_ADDED
 
 
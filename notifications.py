@@ -0,0 +1,130 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from datetime import timedelta
+
+# Import from itools
+from itools.core import freeze
+from itools.csv import Property
+from itools.datatypes import DateTime, String, Unicode
+from itools.gettext import MSG
+
+# Import from crm
+from cache import get_cache
+from comments import CommentsLog
+from utils import get_cached_user
+
+
+MORE_SUBJECT = MSG(u"{subject} (and {n} more)")
+SEPARATOR = u"\n\n%s\n\n" % (u"=" * 76)
+
+
+class DigestQueue(CommentsLog):
+    """ The notifications waiting for the digest, a line each, apart from
+        the metadata of the CRM.
+    """
+    class_mimetypes = ['text/x-crm-digest']
+    class_extension = 'digest'
+    parameters = freeze({
+        'to': String,
+        'subject': Unicode,
+        'date': DateTime})
+
+
+
+def queue_notification(context, username, subject, body):
+    """ Put the notification in the outbox of the request, to be sent by
+        "send_notifications".
+    """
+    outbox = get_cache(context, 'outbox')
+    outbox.setdefault(username, []).append((subject, body))
+
+
+
+def send_messages(context, username, messages):
+    """ Hand the given (subject, body) messages over to the mail spool, that
+        delivers them in the background, as a single e-mail.
+    """
+    user = get_cached_user(context, username)
+    if user is None:
+        return
+    to_addr = user.get_property('email')
+    if not to_addr:
+        return
+    subject, body = messages[0]
+    if len(messages) > 1:
+        subject = MORE_SUBJECT.gettext(subject=subject, n=len(messages) - 1)
+        body = SEPARATOR.join([message[1] for message in messages])
+    context.root.send_email(to_addr, subject, text=body)
+
+
+
+def send_notifications(context, crm):
+    """ Send the notifications of the request, a single e-mail by user.
+
+        In digest mode, they are kept in the CRM and a user gets them all at
+        once when the digest window of the CRM is over.
+    """
+    outbox = get_cache(context, 'outbox')
+    if not outbox:
+        return
+    if not crm.get_property('crm_digest_window'):
+        for username, messages in sorted(outbox.iteritems()):
+            send_messages(context, username, messages)
+        outbox.clear()
+        return
+
+    # Digest mode
+    queue = crm.get_digest_queue(create=True)
+    for username, messages in sorted(outbox.iteritems()):
+        for subject, body in messages:
+            notification = Property(body, to=username, subject=subject,
+                    date=context.timestamp)
+            queue.add_comment(notification)
+    outbox.clear()
+    send_digests(context, crm)
+
+
+
+def send_digests(context, crm, force=False):
+    """ Send the digests of the users whose window is over, or all of them
+        if forced. Return the number of e-mails sent.
+    """
+    queue = crm.get_digest_queue()
+    if not queue.get_n_comments():
+        return 0
+    notifications = queue.get_comments()
+    # The window starts at the first notification of the user
+    window = timedelta(minutes=crm.get_property('crm_digest_window') or 0)
+    by_user = {}
+    for notification in notifications:
+        username = notification.get_parameter('to')
+        by_user.setdefault(username, []).append(notification)
+    n = 0
+    keep = []
+    for username, user_notifications in sorted(by_user.iteritems()):
+        first = user_notifications[0].get_parameter('date')
+        if force or first + window <= context.timestamp:
+            send_messages(context, username,
+                    [(notification.get_parameter('subject'),
+                        notification.value)
+                        for notification in user_notifications])
+            n += 1
+        else:
+            keep.extend(user_notifications)
+    if n:
+        queue.set_comments(keep)
+    return n
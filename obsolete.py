@@ -23,12 +23,25 @@ from itools.datatypes import DateTime, Unicode
 from ikaaro.registry import register_resource_class
 
 # Import from crm
+from company import Company
+from contact import Contact
+from crm import CRM
 from mission import Mission
 
 
 comment_datatype = Mission.class_schema['comment']
 
 
+def move_comments_to_log(resource):
+    """ The comments are appended to a log next to the metadata.
+    """
+    comments = resource.metadata.get_property('comment')
+    if comments:
+        resource.get_comments_log(create=True).set_comments(comments)
+        resource.index_comments()
+    resource.metadata.del_property('comment')
+
+
 class MissionUpdate(Mission):
     class_schema = freeze(merge_dicts(
         Mission.class_schema,
@@ -58,5 +71,49 @@ class MissionUpdate(Mission):
         self.metadata.set_property('comment', comments)
 
 
+    def update_20111020(self):
+        move_comments_to_log(self)
+
+
 
 register_resource_class(MissionUpdate)
+
+
+
+class ContactUpdate(Contact):
+
+    def update_20111020(self):
+        move_comments_to_log(self)
+
+
+
+register_resource_class(ContactUpdate)
+
+
+
+class CompanyUpdate(Company):
+
+    def update_20111020(self):
+        move_comments_to_log(self)
+
+
+
+register_resource_class(CompanyUpdate)
+
+
+
+class CRMUpdate(CRM):
+
+    def update_20111018(self):
+        # Statistics are now stored in the contacts and updated by the
+        # missions, the catalog still has the values computed before
+        self.rebuild_statistics(force=True)
+
+
+    def update_20111019(self):
+        # The contacts store their last modified mission
+        self.rebuild_statistics(force=True)
+
+
+
+register_resource_class(CRMUpdate)
@@ -9,7 +9,7 @@ var widget_name;
 function crm_hide_company_form()
 {
     $('#company').hide();
-    $('select[name=' + widget_name  +']').val(initial_company);
+    $('[name=' + widget_name  +']').val(initial_company);
 }
 
 // Add a link which hide the Edit/New company form
@@ -28,7 +28,7 @@ function crm_show_company_form()
 
 function crm_show_edit()
 {
-    selected_company = $('select[name=' + widget_name +']').val();
+    selected_company = $('[name=' + widget_name +']').val();
     if (selected_company != initial_company)
         if (selected_company != '')
             return false;
@@ -44,7 +44,8 @@ function crm_show_new()
     $('fieldset#company legend').text('New company');
     // As the user decided to affect a new company to a contact, the value of
     // the selector widget is re-initialized.
-    $('select[name=' + widget_name  +']').val('');
+    $('[name=' + widget_name  +']').val('');
+    $('#' + $('[name=' + widget_name  +']').attr('id') + '-title').val('');
     crm_show_company_form();
     // Action on the company is a creation
     $('#action_on_company').val('new')
@@ -53,7 +54,7 @@ function crm_show_new()
 function company_scenario()
 {
     // Did it really changed ?
-    selected_company = $('select[name=' + widget_name + ']').val();
+    selected_company = $('[name=' + widget_name + ']').val();
     // Yes so the company edition is disabled
     if (selected_company != initial_company){
         $("#edit-company").addClass("disabled");
@@ -71,7 +72,7 @@ function company_scenario()
 function crm_main(select_widget, first_widget_id)
 {
     // Get the initial affected company to the contact
-    initial_company = $('select[name=' + select_widget + ']').val();
+    initial_company = $('[name=' + select_widget + ']').val();
     // Get the crm_p_company selector name
     widget_name = select_widget;
 
@@ -87,6 +88,75 @@ function crm_main(select_widget, first_widget_id)
         });
 }
 
+// Fetch the options starting with the typed text, instead of listing them
+// all in the form
+function crm_typeahead(widget_id, search_url)
+{
+    var hidden = $('#' + widget_id);
+    var input = $('#' + widget_id + '-title');
+    var list = $('#' + widget_id + '-options');
+    var last_prefix = null;
+    // The label of the option picked, the hidden value is kept as long as
+    // the text matches it
+    var picked_label = input.val();
+
+    list.hide();
+    input.bind('input keyup', function() {
+        var prefix = input.val();
+        if (prefix == last_prefix)
+            return;
+        last_prefix = prefix;
+        if (prefix != picked_label && hidden.val() != '')
+            hidden.val('').change();
+        if (prefix == '') {
+            list.hide();
+            return;
+        }
+        $.getJSON(search_url, {'prefix': prefix}, function(options) {
+            // Typed further since
+            if (prefix != input.val())
+                return;
+            list.empty();
+            $.each(options, function(i, option) {
+                var item = $('<li></li>').text(option.label);
+                item.click(function() {
+                    hidden.val(option.name).change();
+                    input.val(option.value);
+                    picked_label = last_prefix = option.value;
+                    list.hide();
+                });
+                list.append(item);
+            });
+            if (options.length)
+                list.show();
+            else
+                list.hide();
+        });
+    });
+}
+
+// Replace the "Older comments" link by the next page of comments
+function crm_more_comments(link)
+{
+    var more = $(link).parent();
+    $.get(link.href, function(html) {
+        more.replaceWith(html);
+    });
+    return false;
+}
+
+// Send the choice of the checkbox along with the actions of the table, as
+// the hidden "all_results" field
+function crm_all_results(checkbox_id)
+{
+    var form = $('input[name="ids"]').closest('form');
+    $('#' + checkbox_id).change(function() {
+        form.find('input[name="all_results"]').remove();
+        if (this.checked)
+            form.append('<input type="hidden" name="all_results" value="1"/>');
+    }).change();
+}
+
 
 /*
 $(document).ready(function() {
@@ -16,28 +16,189 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# Import from the Standard Library
+from decimal import Decimal as decimal
+
 # Import from itools
-from itools.database import AndQuery, PhraseQuery
+from itools.database import AndQuery, OrQuery, PhraseQuery
+from itools.handlers.utils import transmap
 
 # Import from ikaaro
 from ikaaro.registry import get_resource_class
 from ikaaro.utils import get_base_path_query
 
+# Import from crm
+from cache import get_cache, lookup_size
+
+
+# The number of searches to keep the aggregates of
+aggregates_cache_size = 200
+
+
+def get_sort_value(value):
+    """ Case and accent independent value to sort on.
+    """
+    if not value:
+        return u''
+    # The translation table needs unicode, e.g. for the e-mails
+    if type(value) is str:
+        value = value.decode('utf_8')
+    return value.lower().translate(transmap)
+
+
+
+def get_cached_resource(context, path):
+    """ Return the resource at the given absolute path, or None, loading it
+        at most once per request.
+    """
+    cache = get_cache(context, 'resources', size=lookup_size)
+    path = str(path)
+    if path not in cache:
+        cache[path] = context.root.get_resource(path, soft=True)
+    return cache[path]
+
+
+
+class LazyResource(object):
+    """ Stand for the resource of a brain in the search tables, loaded only
+        when a value not stored in the brain is needed.
+    """
+
+    def __init__(self, context, brain):
+        self.context = context
+        self.brain = brain
+
+
+    def __getattr__(self, name):
+        resource = get_cached_resource(self.context, self.brain.abspath)
+        return getattr(resource, name)
+
+
+
+class NoResults(object):
+    """ Stand for the results of a search not worth running, without any
+        document.
+    """
+
+    def __len__(self):
+        return 0
+
+
+    def get_documents(self, *args, **kw):
+        return []
+
+
+    def search(self, *args, **kw):
+        return self
+
+
+
+def get_cached_user(context, username):
+    """ Return the user of the given name, or None, loading it at most once
+        per request.
+    """
+    if not username:
+        return None
+    return get_cached_resource(context, '/users/%s' % username)
+
+
+
+def get_user_title(context, username):
+    """ Return the title of the given user, or the name itself if the user
+        does not exist anymore.
+    """
+    cache = get_cache(context, 'user_titles', size=lookup_size)
+    if username not in cache:
+        user = get_cached_user(context, username)
+        if user is None:
+            cache[username] = username
+        else:
+            cache[username] = user.get_title()
+    return cache[username]
+
 
-def generate_code(names, strformat='%03d', index=None):
-    """ Generate a codename with a prefix followed by an integer.
-            generate_code(['c1', 'c3', 'c4'], 'c%03d') -> 'c005'
-            generate_code(['c005'], 'c%03d') -> 'c001'
+
+def get_query_key(query):
+    """ Return a key of the terms of the query, equal for equal queries,
+        to cache the results of a search.
     """
-    if index is None:
-        index = len(names)
-    name = strformat % index
+    if type(query) in (list, tuple):
+        return tuple([get_query_key(x) for x in query])
+    if hasattr(query, '__dict__'):
+        items = sorted(vars(query).iteritems())
+        return (query.__class__.__name__,) + tuple([
+            (name, get_query_key(value)) for name, value in items])
+    return query
+
 
-    while name in names:
-        index = index + 1
-        name = strformat % index
 
-    return name
+def get_aggregates(context, query, sums=(), counts=(), depends=()):
+    """ Return the number of documents matching the query, the sums of the
+        "sums" stored fields, and the number of documents by value of the
+        "counts" stored fields, e.g.:
+
+            {'count': 3,
+             'sums': {'crm_p_assured': Decimal('2000.0')},
+             'counts': {'crm_p_status': {'lead': 2, 'client': 1}}}
+
+        The documents are read in a single pass, and the result is kept
+        until a resource of one of the "depends" class ids changes.
+    """
+    cache = get_cache(context, 'aggregates', scope='process',
+            size=aggregates_cache_size, depends=depends)
+    key = (get_query_key(query), tuple(sums), tuple(counts))
+    aggregates = cache.get(key)
+    if aggregates is not None:
+        return aggregates
+
+    total = 0
+    totals = dict([(name, decimal('0.0')) for name in sums])
+    values = dict([(name, {}) for name in counts])
+    for brain in context.root.search(query).get_documents():
+        total += 1
+        for name in sums:
+            totals[name] += getattr(brain, name) or 0
+        for name in counts:
+            value = getattr(brain, name)
+            if type(value) is not list:
+                value = [value]
+            by_value = values[name]
+            for x in value:
+                if x:
+                    by_value[x] = by_value.get(x, 0) + 1
+    aggregates = cache[key] = {
+        'count': total,
+        'sums': totals,
+        'counts': values}
+    return aggregates
+
+
+
+def reindex_resources(context, paths):
+    """ Mark the resources at the given paths as changed, so they are
+        indexed again, once, at the end of the transaction.
+
+        The paths already queued during the transaction are skipped without
+        loading their resource again.
+    """
+    queued = get_cache(context, 'reindex')
+    root = context.root
+    database = context.database
+    for path in paths:
+        path = str(path)
+        if path in queued:
+            continue
+        queued[path] = True
+        resource = root.get_resource(path, soft=True)
+        if resource is not None:
+            database.change_resource(resource)
+
+
+
+def reindex_brains(context, brains):
+    """ Mark the resources of the given brains as changed.
+    """
+    reindex_resources(context, [brain.abspath for brain in brains])
 
 
 
@@ -56,6 +217,19 @@ def get_crm_path_query(crm_resource):
 
 
 
+def get_text_query(context, search_text):
+    """ Search the text of the small fields and of the comments, indexed
+        apart.
+    """
+    query = AndQuery(PhraseQuery('format', 'crm-comment'),
+            PhraseQuery('crm_comments', search_text))
+    results = context.root.search(query)
+    paths = set([brain.crm_comment_of for brain in results.get_documents()])
+    query = [PhraseQuery('abspath', path) for path in sorted(paths)]
+    return OrQuery(PhraseQuery('text', search_text), *query)
+
+
+
 def get_contact_title(brain, context):
     # TODO merge with Contact.get_title
     p_lastname = brain.crm_p_lastname.upper()
@@ -72,6 +246,28 @@ def get_contact_title(brain, context):
 
 
 
+def get_mission_statistics(status, amount, probability):
+    """ Return the contribution of a mission to the statistics of each of
+        its contacts.
+    """
+    statistics = {}
+    if status:
+        statistics['crm_p_' + status] = 1
+    if status == 'nogo':
+        return statistics
+    amount = amount or 0
+    if status in ('project', 'finished'):
+        # Assured amount (sum projects amounts)
+        statistics['crm_p_assured'] = amount
+    else:
+        # Probable amount (average missions amount by probability)
+        probability = probability or 0
+        cent = decimal('100.0')
+        statistics['crm_p_probable'] = (probability * amount) / cent
+    return statistics
+
+
+
 # FIXME reuse itws one
 def get_path_and_view(path):
     view = ''
@@ -18,11 +18,15 @@
 
 # Import from itools
 from itools.core import thingy_lazy_property
+from itools.web import get_context
 
 # Import from ikaaro
-from ikaaro.autoform import CheckboxWidget, SelectWidget, TextWidget
+from ikaaro.autoform import CheckboxWidget, TextWidget
 from ikaaro.autoform import make_stl_template
 
+# Import from crm
+from utils import get_crm
+
 
 class MultipleCheckboxWidget(CheckboxWidget):
 
@@ -42,15 +46,33 @@ class MultipleCheckboxWidget(CheckboxWidget):
         return items
 
 
-class SelectCompanyWidget(SelectWidget):
+class SelectCompanyWidget(TextWidget):
+    """ Type-ahead on the companies, instead of listing them all.
+    """
 
     template = make_stl_template("""
-        <select id="${id}" name="${name}" multiple="${multiple}" size="${size}"
-            class="${css}">
-          <option value="" stl:if="has_empty_option"></option>
-          <option stl:repeat="option options" value="${option/name}"
-            selected="${option/selected}">${option/value}</option>
-        </select>""")
+        <input type="hidden" id="${id}" name="${name}" value="${value}" />
+        <input type="text" id="${id}-title" value="${title_value}"
+          size="${size}" autocomplete="off" />
+        <ul id="${id}-options" class="crm-typeahead"></ul>
+        <script type="text/javascript">
+          crm_typeahead("${id}", "${search_url}");
+        </script>""")
+    size = 30
+
+
+    @thingy_lazy_property
+    def title_value(self):
+        if not self.value:
+            return u''
+        return self.datatype.get_value(self.value, default=self.value)
+
+
+    @thingy_lazy_property
+    def search_url(self):
+        context = get_context()
+        crm = get_crm(context.resource)
+        return '%s/companies/;search_json' % context.get_link(crm)
 
 
 class EmailWidget(TextWidget):